@@ -7,6 +7,7 @@ import theano
 from code.data_reader import read_data
 from code.datahelper import DataHelper
 from code.recurrent_loglinear import RecurrentLoglinear
+from code.np_loglinear import NumpyLoglinear
 from code.rewards import Reward
 from code.dqn import DQNTheano as DQN
 from code.actor import Actor
@@ -89,6 +90,18 @@ def load_json_model(file_path):
     bl = 0.0
     do_clip = 'free'
     top_k = 'top_all'
+    if options.numpy_engine:
+        #the simulated students only need the step functions, skip the theano compile
+        print 'loaded', file_path
+        return NumpyLoglinear(dh,
+                grad_transform = grad_transform,
+                learning_model = model,
+                grad_model = grad_model,
+                clip = do_clip,
+                grad_top_k = top_k,
+                saved_weights = file_path)
+    else:
+        pass
     recurrent_ll = RecurrentLoglinear(dh,
             u = grad_update,
             reg = (regularization / len(TRAINING_SEQ)),
@@ -108,7 +121,9 @@ def load_json_model(file_path):
 def get_observation(action_idx, rll, theta_tm1, disp=False):
     if disp:
         print dh.actions[action_idx]
-    a_type, _x_t, _yt_t, _o_t = dh.action_vectors[action_idx]
+    #copy, the correct/incorrect flags are set per observation
+    a_type = dh.action_types[action_idx].copy()
+    _x_t, _yt_t, _o_t = dh.action_xs[action_idx], dh.action_yts[action_idx], dh.action_options[action_idx]
     assert type(a_type) == np.ndarray
     assert a_type.shape == (10,)
     if disp:
@@ -224,6 +239,7 @@ if __name__ == '__main__':
     opt.add_argument('--episode_length', action='store', dest='EPISODE_LENGTH', default=10, type=int, required = True)
     opt.add_argument('--save_fig', action='store', dest='save_fig', required = True)
     opt.add_argument('--all_actions', action='store_true', dest='ALL_ACTIONS', default = False)
+    opt.add_argument('--numpy', action='store_true', dest='numpy_engine', default=False)
     options = opt.parse_args()
 
     events_file = './data/content/fake-en-medium.' + options.feature  +'.event2feats'
@@ -279,7 +295,7 @@ if __name__ == '__main__':
                 a_hat = actor.get_a_hat(reshaped_B_tm1.astype(floatX))
                 action_idx_t = np.random.choice(len(dh.actions), 1, p=a_hat[0,:])[0] #always explore to train...
 
-            a_type, _x_t, _yt_t, _o_t = dh.action_vectors[action_idx_t]
+            _x_t, _o_t = dh.action_xs[action_idx_t], dh.action_options[action_idx_t]
             y_sel_j, y_sel_j_vec, y_hat_j, context_t = get_observation(action_idx_t, rll_j, theta_tm1_j, disp=False)
             theta_t_j, g_r_j, g_z_j = rll_j.get_step_transition(_x_t, y_sel_j_vec.astype(floatX), _o_t.astype(floatX), context_t.astype(floatX), context_tm1.astype(floatX), theta_tm1_j.astype(floatX))
             term_t = None
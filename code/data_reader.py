@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 import sys
+import os
+import hashlib
 import codecs
 import numpy as np
 import theano
+from my_utils import save_obj, load_obj, save_npy, save_atomic, source_stamp, is_fresh
 sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 
 __author__ = 'arenduchintala'
@@ -14,44 +17,189 @@ else:
     floatX = np.float64
     intX = np.int64
 
-def read_data(file_path, dh):
+SEQ_FIELDS = ['X', 'Y', 'YT', 'O', 'S']
+CONTEXT_SIZE = 10 #S only holds the context flags, x, o and y_selected are already in X, O and Y
+DATA_CACHE_VERSION = 2
+
+class PackedSeqs(object):
+    #all users of a split in one contiguous array per field (X, Y, YT, O, S),
+    #user i is rows offsets[i]:offsets[i + 1]. indexing a user returns zero-copy views,
+    #a contiguous slice of users is again a PackedSeqs over views.
+    def __init__(self, fields, offsets):
+        assert len(fields) == len(SEQ_FIELDS)
+        self.fields = fields
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, "only contiguous slices of users"
+            stop = max(start, stop)
+            s, e = self.offsets[start], self.offsets[stop]
+            return PackedSeqs([f[s:e] for f in self.fields], self.offsets[start:stop + 1] - s)
+        else:
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError("user index out of range")
+            s, e = self.offsets[idx], self.offsets[idx + 1]
+            return tuple([f[s:e] for f in self.fields])
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def resets(self):
+        #(total_events,) 1.0 at the first event of each user, the R input of RecurrentLoglinear's packed functions
+        r = np.zeros(self.offsets[-1], dtype=floatX)
+        starts = self.offsets[:-1][self.lengths() > 0]
+        r[starts] = 1.0
+        return r
+
+    def take(self, ids):
+        #copies the given users (e.g. a shuffled or length-bucketed subset) into a new packed store
+        ids = np.asarray(ids, dtype=np.int64)
+        lengths = self.lengths()[ids]
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in ids]) if ids.shape[0] > 0 else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(ids.shape[0] + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        return PackedSeqs([f[rows] for f in self.fields], offsets)
+
+def length_batches(SEQ, batch_size, shuffle = True):
+    #groups users of similar length into batches of user ids, so padding a batch wastes little.
+    #ties between equal lengths and the order of the batches are shuffled
+    lengths = SEQ.lengths() if isinstance(SEQ, PackedSeqs) else np.array([seq[0].shape[0] for seq in SEQ])
+    noise = np.random.rand(lengths.shape[0]) if shuffle else np.zeros(lengths.shape[0])
+    order = np.argsort(lengths + noise, kind='mergesort')
+    order = order[lengths[order] > 0] #nothing to train on in an empty user
+    batches = [order[i:i + batch_size] for i in xrange(0, order.shape[0], batch_size)]
+    if shuffle:
+        batches = [batches[i] for i in np.random.permutation(len(batches))]
+    else:
+        pass
+    return batches
+
+def pad_batch(SEQ, ids):
+    #stacks the given users into (batch_size, max_len, ...) arrays padded at the end,
+    #plus SM1 (S shifted by one per user, as pad_start) and the mask M of real events
+    seqs = [SEQ[i] for i in ids]
+    B = len(seqs)
+    T_max = max([seq[0].shape[0] for seq in seqs])
+    E_SIZE = seqs[0][1].shape[1]
+    C_SIZE = seqs[0][4].shape[1]
+    X = np.zeros((B, T_max), dtype=np.int32)
+    Y = np.zeros((B, T_max, E_SIZE), dtype=np.float32)
+    YT = np.zeros((B, T_max), dtype=np.int32)
+    O = np.zeros((B, T_max, E_SIZE), dtype=np.float32)
+    S = np.zeros((B, T_max, C_SIZE), dtype=np.float32)
+    M = np.zeros((B, T_max), dtype=np.float32)
+    for b, (_x, _y, _yt, _o, _s) in enumerate(seqs):
+        n = _x.shape[0]
+        X[b, :n] = _x
+        Y[b, :n] = _y
+        YT[b, :n] = _yt
+        O[b, :n] = _o
+        S[b, :n] = _s
+        M[b, :n] = 1.0
+    SM1 = np.zeros_like(S)
+    SM1[:, 1:, :] = S[:, :-1, :]
+    return X, Y, YT, O, S, SM1, M
+
+def data_cache_prefix(file_path, dh):
+    #the ids depend on the feature files, so the cache name carries the DataHelper cache name
+    key = hashlib.md5(os.path.basename(dh.cache_path) + str(DATA_CACHE_VERSION)).hexdigest()[:8]
+    return file_path + '.' + key
+
+def load_packed_npz(npz_path, sources):
+    try:
+        f = np.load(npz_path)
+        stamps = zip(f['stamp_size'].tolist(), f['stamp_mtime'].tolist(), f['stamp_hash'].tolist())
+        if not is_fresh(stamps, sources):
+            return None
+        return PackedSeqs([f[n] for n in SEQ_FIELDS], f['offsets'])
+    except Exception:
+        return None #no cache yet or a half written one
+
+def save_packed_npz(seqs, npz_path, sources):
+    stamps = [source_stamp(p) for p in sources]
+    arrays = dict(zip(SEQ_FIELDS, seqs.fields))
+    arrays['offsets'] = seqs.offsets
+    arrays['stamp_size'] = np.array([st[0] for st in stamps], dtype=np.int64)
+    arrays['stamp_mtime'] = np.array([st[1] for st in stamps], dtype=np.float64)
+    arrays['stamp_hash'] = np.array([st[2] for st in stamps])
+    return save_atomic(lambda a, p: np.savez(open(p, 'wb'), **a), arrays, npz_path)
+
+def read_data_mmap(file_path, dh):
+    #packed sequences as read-only memory-mapped .npy files next to the .data file,
+    #parallel workers reading the same split share one physical copy
+    prefix = data_cache_prefix(file_path, dh)
+    sources = [file_path] + dh.sources
+    names = SEQ_FIELDS + ['offsets']
+    try:
+        fresh = is_fresh(load_obj(prefix + '.meta')['stamps'], sources) and all([os.path.exists(prefix + '.' + n + '.npy') for n in names])
+    except Exception:
+        fresh = False #no meta yet or a half written one
+    if not fresh:
+        seqs = read_data(file_path, dh)
+        saved = [save_atomic(save_npy, a, prefix + '.' + n + '.npy') for n, a in zip(names, seqs.fields + [seqs.offsets])]
+        if not all(saved):
+            return seqs #could not write next to the data, keep it in memory
+        else:
+            save_atomic(save_obj, {'stamps': [source_stamp(p) for p in sources]}, prefix + '.meta')
+    else:
+        pass
+    fields = [np.load(prefix + '.' + n + '.npy', mmap_mode='r') for n in SEQ_FIELDS]
+    offsets = np.load(prefix + '.offsets.npy')
+    return PackedSeqs(fields, offsets)
+
+def read_data(file_path, dh, mmap = False, use_cache = True):
+    if mmap:
+        return read_data_mmap(file_path, dh)
+    else:
+        pass
+    npz_path = data_cache_prefix(file_path, dh) + '.npz'
+    sources = [file_path] + dh.sources
+    if use_cache:
+        seqs = load_packed_npz(npz_path, sources)
+        if seqs is not None:
+            return seqs
+        else:
+            pass
+    else:
+        pass
+    seqs = parse_data(file_path, dh)
+    if use_cache:
+        save_packed_npz(seqs, npz_path, sources)
+    else:
+        pass
+    return seqs
+
+def parse_data(file_path, dh):
     data_lines = []
     data_lines += codecs.open(file_path, 'r', 'utf8').readlines()
-    TRAINING_SEQ = []
+    user_ids = [] #user index of every kept event
+    X, E_SEL, YT, O_ALL, O_IDS, C = [], [], [], [], [], []
+    n_users = 0
     prev_user = None
-    X, Y, YT, O, S = None, None, None, None, None
     for line in data_lines:
         user, uts, ptype, tstep, a_idx, fr, en_true, en_options, en_selected, fb, is_qc  = [i.strip() for i in line.split('\t')]
         if user != prev_user:
-            if X is not None and Y is not None and O is not None and S is not None and YT is not None:
-                TRAINING_SEQ.append((np.array(X, dtype=np.int32),
-                    np.array(Y, dtype=np.float32),
-                    np.array(YT, dtype=np.int32),
-                    np.array(O, dtype=np.float32),
-                    np.array(S, dtype=np.float32)))
-            else:
-                pass
-            X, Y, YT, O, S = [],[],[],[],[] #clearing out 
+            n_users += 1
         if en_selected != "NO_ANSWER_MADE":
-            x = dh.f2id[fr] #x
-            t_id = dh.e2id[en_true]
-            e_id = dh.e2id[en_selected] #y index
-            y_true = t_id #np.zeros((dh.E_SIZE,)) #y
-            #y_true[t_id] = 1.0
-            y_selected = np.zeros((dh.E_SIZE,)) #y
-            y_selected[e_id] = 1.0 #set what the user selected to 1, and the rest to zero
             if en_options == "ALL":
-                o = np.ones((dh.E_SIZE,)).astype(floatX)
+                o_ids = []
                 r_choice = dh.E_SIZE
             else:
-                o = np.zeros((dh.E_SIZE,)).astype(floatX)
-                r_choice = len(en_options.split(','))
-                for os in en_options.split(','):
-                    o_id = dh.e2id[os.strip()]
-                    o[o_id] = 1.0
-            o = o.astype(intX)
-            y_selected = y_selected.astype(intX)
-            t = [0,0,0,0,0,0,0,0,0,0]
+                o_ids = [dh.e2id[_o.strip()] for _o in en_options.split(',')]
+                r_choice = len(o_ids)
+            assert r_choice > 0.0
+            t = [0] * CONTEXT_SIZE
             t[0] = 1 if ptype in ["EX"] else 0
             t[1] = 1 if ptype in ["TP", "TPR"] else 0
             t[2] = 1 if ptype in ["MC", "MCR"] else 0
@@ -62,23 +210,25 @@ def read_data(file_path, dh):
             t[7] = 1 if is_qc == 'test_correct' else 0
             t[8] = 1 if is_qc == 'test_incorrect' else 0
             t[9] = np.log(1.0 / float(r_choice))
-            x_vec = np.zeros(dh.E_SIZE,)
-            x_vec[x] = 1.0
-            t = np.asarray(t)
-            t = np.concatenate((t.astype(floatX), x_vec.astype(floatX), o.astype(floatX), y_selected.astype(floatX)), axis=0)
-            t = t.astype(floatX)
-            assert r_choice > 0.0
-
-            X.append(x)
-            Y.append(y_selected)
-            YT.append(y_true)
-            O.append(o)
-            S.append(t)
+            user_ids.append(n_users - 1)
+            X.append(dh.f2id[fr]) #x
+            E_SEL.append(dh.e2id[en_selected]) #y index
+            YT.append(dh.e2id[en_true])
+            O_ALL.append(en_options == "ALL")
+            O_IDS.append(o_ids)
+            C.append(t)
         prev_user = user
-
-    TRAINING_SEQ.append((np.array(X, dtype=np.int32),
-        np.array(Y, dtype=np.float32),
-        np.array(YT, dtype=np.int32),
-        np.array(O, dtype=np.float32),
-        np.array(S, dtype=np.float32)))
-    return TRAINING_SEQ
+    N = len(X)
+    rows = np.arange(N)
+    X = np.array(X, dtype=np.int32)
+    YT = np.array(YT, dtype=np.int32)
+    Y = np.zeros((N, dh.E_SIZE), dtype=np.float32) #one-hot y_selected
+    Y[rows, E_SEL] = 1.0
+    O = np.zeros((N, dh.E_SIZE), dtype=np.float32) #mask for possible Ys
+    O[np.array(O_ALL, dtype=bool), :] = 1.0
+    o_rows = np.repeat(rows, [len(o_ids) for o_ids in O_IDS])
+    O[o_rows, [o_id for o_ids in O_IDS for o_id in o_ids]] = 1.0
+    S = np.array(C, dtype=floatX).reshape((N, CONTEXT_SIZE)).astype(np.float32)
+    offsets = np.zeros(n_users + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(np.array(user_ids, dtype=np.int64), minlength=n_users))
+    return PackedSeqs([X, Y, YT, O, S], offsets)
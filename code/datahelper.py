@@ -1,53 +1,274 @@
 #!/usr/bin/env python
+import os
+import hashlib
 import numpy as np
 import codecs
+import theano
+import scipy.sparse
+import scipy.sparse.linalg
+from my_utils import save_obj, load_obj, save_npy, save_atomic, source_stamp, is_fresh
 __author__ = 'arenduchintala'
 
+if theano.config.floatX == 'float32':
+    floatX = np.float32
+else:
+    floatX = np.float64
+
+CACHE_VERSION = 1
+
 class DataHelper(object):
-    def __init__(self, event2feats_path, feat2id_path, actions_path, quiz_actions_path = None):
+    #everything parsed from the text files, saved to and restored from the binary cache
+    cached_attrs = ['f2id', 'e2id', 'id2f', 'id2e', 'feat2id', 'id2feat', 'all_e_ids',
+            'E_SIZE', 'F_SIZE', 'FEAT_SIZE', 'true_f2e', 'true_e2f',
+            'actions', 'example', 'action_vectors', 'quiz_actions', 'quiz_action_vectors',
+            'phi_indptr', 'phi_indices', 'phi_data', 'phi_rows']
+
+    def __init__(self, event2feats_path, feat2id_path, actions_path, quiz_actions_path = None, phi_type = "dense", use_cache = True, mmap = False, low_rank = 100):
         self.f2id = {}
         self.e2id = {}
         self.id2f = {}
         self.id2e = {}
         self.feat2id = {}
         self.id2feat = {}
-        self.event2feats = {}
         self.all_e_ids = None
         self.examples = []
         self.actions = []
         self.quiz_actions = []
         self.action_vectors = []
         self.quiz_action_vectors = []
+        self.action_types = None
+        self.action_xs = None
+        self.action_yts = None
+        self.action_options = None
+        self.quiz_action_types = None
+        self.quiz_action_xs = None
+        self.quiz_action_yts = None
+        self.quiz_action_options = None
+        self.max_options = 0
         self.E_SIZE = 0
         self.F_SIZE = 0
         self.FEAT_SIZE = 0
         self.true_f2e = {}
         self.true_e2f = {}
-        self.load_event2feats(event2feats_path)
-        self.load_feats(feat2id_path)
-        self.actions, self.example = self.load_actions(actions_path)
-        self.action_vectors = self.load_action_vectors(self.actions)
-        if quiz_actions_path is not None:
-            self.quiz_actions, _ = self.load_actions(quiz_actions_path)
-            self.quiz_action_vectors  = self.load_action_vectors(self.quiz_actions)
+        self.phi_type = phi_type
+        self.phi = None
+        self.phi_indptr = None
+        self.phi_indices = None
+        self.phi_data = None
+        self.phi_rows = None
+        self.phi_active_idx = None
+        self.phi_active = None
+        self.phi_u = None
+        self.phi_v = None
+        self.phi_bin_idx = None
+        self.phi_binary = False
+        self.low_rank = low_rank
+        self.mmap = mmap
+        sources = [p for p in [event2feats_path, feat2id_path, actions_path, quiz_actions_path] if p is not None]
+        self.sources = sources
+        self.cache_path = self.get_cache_path(sources)
+        if use_cache and self.load_cache(self.cache_path, sources):
+            pass #event2feats is rebuilt from the csr arrays on first use, see __getattr__
+        else:
+            self.event2feats = {}
+            self.load_event2feats(event2feats_path)
+            self.load_feats(feat2id_path)
+            self.actions, self.example = self.load_actions(actions_path)
+            self.action_vectors = self.load_action_vectors(self.actions)
+            if quiz_actions_path is not None:
+                self.quiz_actions, _ = self.load_actions(quiz_actions_path)
+                self.quiz_action_vectors  = self.load_action_vectors(self.quiz_actions)
+            else:
+                pass
+            self.phi_indptr, self.phi_indices, self.phi_data, self.phi_rows = self.load_phi_csr()
+            if use_cache:
+                self.save_cache(self.cache_path, sources)
+            else:
+                pass
+        self.action_types, self.action_xs, self.action_yts, self.action_options = self.load_action_table(self.action_vectors)
+        self.quiz_action_types, self.quiz_action_xs, self.quiz_action_yts, self.quiz_action_options = self.load_action_table(self.quiz_action_vectors)
+        self.max_options = self.load_max_options(self.action_options)
+        self.phi_binary = bool(np.all(self.phi_data == 1.0)) #every feature value is 1, phi is just which features are on
+        if self.phi_type == "binary" and not self.phi_binary:
+            self.phi_type = "active" #real valued features keep the float path
+        else:
+            pass
+        if self.phi_type == "dense":
+            self.phi = self.load_mmap('phi', self.load_phi) if self.mmap else self.load_phi()
+        elif self.phi_type == "sparse":
+            pass
+        elif self.phi_type == "active":
+            if self.mmap:
+                self.phi_active_idx = self.load_mmap('phi_active_idx', lambda: self.load_phi_active()[0])
+                self.phi_active = self.load_mmap('phi_active', lambda: self.load_phi_active()[1])
+            else:
+                self.phi_active_idx, self.phi_active = self.load_phi_active()
+        elif self.phi_type == "binary":
+            self.phi_bin_idx = self.load_mmap('phi_bin_idx', self.load_phi_binary) if self.mmap else self.load_phi_binary()
+        elif self.phi_type == "lowrank":
+            if self.mmap:
+                self.phi_u = self.load_mmap('phi_u.r' + str(self.low_rank), lambda: self.load_phi_lowrank()[0])
+                self.phi_v = self.load_mmap('phi_v.r' + str(self.low_rank), lambda: self.load_phi_lowrank()[1])
+            else:
+                self.phi_u, self.phi_v = self.load_phi_lowrank()
+        else:
+            raise BaseException("unknown phi type")
+        if self.mmap:
+            self.phi_indptr = self.load_mmap('phi_indptr', lambda: self.phi_indptr)
+            self.phi_indices = self.load_mmap('phi_indices', lambda: self.phi_indices)
+            self.phi_data = self.load_mmap('phi_data', lambda: self.phi_data)
+            self.phi_rows = self.load_mmap('phi_rows', lambda: self.phi_rows)
         else:
             pass
-        self.phi = self.load_phi()
         assert len(self.actions) == len(self.action_vectors)
         assert len(self.quiz_actions) == len(self.quiz_action_vectors)
 
+    def __getattr__(self, name):
+        #only reached when name is not set yet, i.e. event2feats after a cache load
+        if name == 'event2feats' and self.__dict__.get('phi_indptr') is not None:
+            self.event2feats = self.load_event2feats_from_csr()
+            return self.event2feats
+        else:
+            raise AttributeError(name)
+
     def _phi(self, f_idx, e_idx):
         ff = np.zeros(self.FEAT_SIZE)
-        ff_idx, ff_vals = self.event2feats[f_idx, e_idx]
-        ff[ff_idx] = ff_vals
+        r = f_idx * self.E_SIZE + e_idx
+        ff[self.phi_indices[self.phi_indptr[r]:self.phi_indptr[r + 1]]] = self.phi_data[self.phi_indptr[r]:self.phi_indptr[r + 1]]
+        return ff
+
+    def _phis(self, f_idxs, e_idxs):
+        #(N, FEAT) rows of phi for N (f, e) pairs
+        ff = np.zeros((len(f_idxs), self.FEAT_SIZE))
+        r = np.asarray(f_idxs) * self.E_SIZE + np.asarray(e_idxs)
+        nnz = self.phi_indptr[r + 1] - self.phi_indptr[r]
+        entries = np.repeat(self.phi_indptr[r] - np.cumsum(nnz) + nnz, nnz) + np.arange(np.sum(nnz))
+        ff[np.repeat(np.arange(len(r)), nnz), self.phi_indices[entries]] = self.phi_data[entries]
         return ff
 
+    def get_cache_path(self, sources):
+        #one cache per combination of source files, stored next to the event2feats file
+        key = hashlib.md5('|'.join([os.path.basename(p) for p in sources])).hexdigest()[:8]
+        return sources[0] + '.' + key + '.cache'
+
+    def load_mmap(self, name, build):
+        #read-only memory-mapped copy of a phi array next to the cache, so parallel workers share one physical copy.
+        #float arrays are stored in floatX so the theano shared variables can borrow them without a copy
+        npy_path = self.cache_path + '.' + name + '.npy'
+        if not (os.path.exists(self.cache_path) and os.path.exists(npy_path) and os.path.getmtime(npy_path) >= os.path.getmtime(self.cache_path)):
+            arr = build()
+            arr = arr.astype(floatX) if arr.dtype.kind == 'f' else arr
+            if not save_atomic(save_npy, arr, npy_path):
+                return arr #could not write next to the sources, keep it in memory
+            else:
+                pass
+        return np.load(npy_path, mmap_mode='r')
+
+    def load_cache(self, cache_path, sources):
+        if not os.path.exists(cache_path):
+            return False
+        try:
+            cache = load_obj(cache_path)
+        except Exception:
+            return False
+        if cache.get('version') != CACHE_VERSION or not is_fresh(cache['stamps'], sources):
+            return False
+        for attr in self.cached_attrs:
+            setattr(self, attr, cache[attr])
+        return True
+
+    def save_cache(self, cache_path, sources):
+        cache = dict([(attr, getattr(self, attr)) for attr in self.cached_attrs])
+        cache['version'] = CACHE_VERSION
+        cache['stamps'] = [source_stamp(p) for p in sources]
+        return save_atomic(save_obj, cache, cache_path)
+
     def load_phi(self):
-        p = np.zeros((self.F_SIZE, self.E_SIZE, self.FEAT_SIZE))
-        for f_idx in xrange(self.F_SIZE):
-            for e_idx in xrange(self.E_SIZE):
-                p[f_idx, e_idx, :]  = self._phi(f_idx, e_idx)
+        #dense (F, E, FEAT) phi, scattered from the csr arrays
+        p = np.zeros((self.F_SIZE * self.E_SIZE, self.FEAT_SIZE))
+        row_ids = np.repeat(np.arange(self.F_SIZE * self.E_SIZE), np.diff(self.phi_indptr))
+        p[row_ids, self.phi_indices] = self.phi_data
+        p = np.reshape(p, (self.F_SIZE, self.E_SIZE, self.FEAT_SIZE))
         return p
+
+    def load_phi_active(self):
+        #per x, the union of feature columns active for any e (k_x of them), padded to K = max k_x
+        #phi_active_idx (F, K) holds the column ids, phi_active (F, E, K) the compacted phi[x] block,
+        #padded slots point at column 0 with value 0 so they add nothing to scores or gradients
+        active = []
+        for x in xrange(self.F_SIZE):
+            start, end = self.phi_indptr[x * self.E_SIZE], self.phi_indptr[(x + 1) * self.E_SIZE]
+            active.append(np.unique(self.phi_indices[start:end]))
+        K = max([len(a) for a in active])
+        active_idx = np.zeros((self.F_SIZE, K), dtype=np.int32)
+        phi_active = np.zeros((self.F_SIZE, self.E_SIZE, K))
+        for x, a in enumerate(active):
+            active_idx[x, :len(a)] = a
+            start, end = self.phi_indptr[x * self.E_SIZE], self.phi_indptr[(x + 1) * self.E_SIZE]
+            cols = np.searchsorted(a, self.phi_indices[start:end])
+            phi_active[x, self.phi_rows[start:end], cols] = self.phi_data[start:end]
+        return active_idx, phi_active
+
+    def load_phi_binary(self):
+        #binary phi as index lists: phi_bin_idx[x, e] holds the ids of the features that are on for (x, e),
+        #padded to L = the most features any (x, e) has with FEAT_SIZE, a slot past theta that reads as 0
+        nnz = np.diff(self.phi_indptr)
+        L = max(1, np.max(nnz))
+        row_ids = np.repeat(np.arange(self.F_SIZE * self.E_SIZE), nnz)
+        pos = np.arange(self.phi_indptr[-1]) - np.repeat(self.phi_indptr[:-1], nnz)
+        bin_idx = np.full((self.F_SIZE * self.E_SIZE, L), self.FEAT_SIZE, dtype=np.int32)
+        bin_idx[row_ids, pos] = self.phi_indices
+        return np.reshape(bin_idx, (self.F_SIZE, self.E_SIZE, L))
+
+    def load_phi_lowrank(self):
+        #rank r factorisation of phi stacked as (F * E, FEAT): phi[x, e] ~= phi_u[x, e].dot(phi_v) with phi_u (F, E, r)
+        #and phi_v (r, FEAT) shared by every x, from a truncated svd of the csr arrays (phi is never made dense)
+        p = scipy.sparse.csr_matrix((self.phi_data, self.phi_indices, self.phi_indptr), shape=(self.F_SIZE * self.E_SIZE, self.FEAT_SIZE))
+        r = min(self.low_rank, min(p.shape) - 1)
+        v0 = np.ones(min(p.shape)) / np.sqrt(min(p.shape)) #fixed start, so the factors are the same on every load
+        u, sv, vt = scipy.sparse.linalg.svds(p, k=r, v0=v0)
+        order = np.argsort(-sv)
+        phi_u = np.reshape(u[:, order] * sv[order], (self.F_SIZE, self.E_SIZE, r))
+        phi_v = vt[order, :]
+        return phi_u, phi_v
+
+    def lowrank_error(self):
+        #relative frobenius error |phi[x] - phi_u[x].dot(phi_v)| / |phi[x]| of every x, and of the whole phi
+        err = np.zeros(self.F_SIZE)
+        norm = np.zeros(self.F_SIZE)
+        for x in xrange(self.F_SIZE):
+            phi_x = np.zeros((self.E_SIZE, self.FEAT_SIZE))
+            start, end = self.phi_indptr[x * self.E_SIZE], self.phi_indptr[(x + 1) * self.E_SIZE]
+            phi_x[self.phi_rows[start:end], self.phi_indices[start:end]] = self.phi_data[start:end]
+            err[x] = np.sum(np.square(phi_x - np.dot(self.phi_u[x], self.phi_v)))
+            norm[x] = np.sum(np.square(phi_x))
+        return np.sqrt(err / np.maximum(norm, 1e-12)), np.sqrt(np.sum(err) / np.sum(norm))
+
+    def lowrank_report(self):
+        per_x, total = self.lowrank_error()
+        worst = np.argsort(-per_x)[:5]
+        msg = 'phi rank:' + str(self.phi_v.shape[0]) + ' feats:' + str(self.FEAT_SIZE) + ' rel err:' + '%.4f' % total
+        msg += ' mean x:' + '%.4f' % np.mean(per_x) + ' max x:' + '%.4f' % np.max(per_x)
+        msg += ' worst:' + ','.join([self.id2f[x] + '=' + '%.4f' % per_x[x] for x in worst])
+        return msg
+
+    def load_phi_csr(self):
+        #csr rows are keyed by (f, e) as row = f * E_SIZE + e, so the rows of a given x
+        #are contiguous: indptr[x * E_SIZE] to indptr[(x + 1) * E_SIZE]
+        #phi_rows holds the e of every stored entry (needed to scatter scores back to (E,))
+        row_nnz = np.zeros(self.F_SIZE * self.E_SIZE, dtype=np.int32)
+        for (f_idx, e_idx), (ff_idx, ff_vals) in self.event2feats.iteritems():
+            row_nnz[f_idx * self.E_SIZE + e_idx] = len(ff_idx)
+        indptr = np.zeros(self.F_SIZE * self.E_SIZE + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(row_nnz)
+        indices = np.zeros(indptr[-1], dtype=np.int32)
+        data = np.zeros(indptr[-1], dtype=np.float64)
+        for (f_idx, e_idx), (ff_idx, ff_vals) in self.event2feats.iteritems():
+            r = f_idx * self.E_SIZE + e_idx
+            indices[indptr[r]:indptr[r + 1]] = ff_idx
+            data[indptr[r]:indptr[r + 1]] = ff_vals
+        rows = np.repeat(np.arange(self.F_SIZE * self.E_SIZE) % self.E_SIZE, row_nnz).astype(np.int32)
+        return indptr, indices, data, rows
     
     def load_action_vectors(self, action_list):
         action_vectors = []
@@ -81,6 +302,26 @@ class DataHelper(object):
             action_vectors.append((a_type, x_t, yt_t, o_t))
         return action_vectors
 
+    def load_action_table(self, action_vectors):
+        #struct-of-arrays copy of action_vectors, row i of each array is action i:
+        #(A, 10) a_type, (A,) x and yt ids, (A, E) option mask
+        action_types = np.zeros((len(action_vectors), 10), dtype=np.float32)
+        action_xs = np.zeros(len(action_vectors), dtype=np.int32)
+        action_yts = np.zeros(len(action_vectors), dtype=np.int32)
+        action_options = np.zeros((len(action_vectors), self.E_SIZE), dtype=np.float32)
+        for a_idx, (a_type, x_t, yt_t, o_t) in enumerate(action_vectors):
+            action_types[a_idx] = a_type
+            action_xs[a_idx] = x_t
+            action_yts[a_idx] = yt_t
+            action_options[a_idx] = o_t
+        return action_types, action_xs, action_yts, action_options
+
+    def load_max_options(self, action_options):
+        #most options a multiple choice prompt shows, prompts over all of E ("ALL") are not counted
+        n_options = np.sum(action_options, axis=1)
+        n_options = n_options[n_options < self.E_SIZE]
+        return int(np.max(n_options)) if n_options.shape[0] > 0 else 1
+
     def load_actions(self, actions_path):
         actions = []
         examples = []
@@ -128,3 +369,14 @@ class DataHelper(object):
         self.E_SIZE = len(self.e2id)
         self.F_SIZE = len(self.f2id)
         return True
+
+    def load_event2feats_from_csr(self):
+        event2feats = {}
+        for r in xrange(self.F_SIZE * self.E_SIZE):
+            if self.phi_indptr[r] < self.phi_indptr[r + 1]:
+                f_id, e_id = divmod(r, self.E_SIZE)
+                event2feats[f_id, e_id] = (self.phi_indices[self.phi_indptr[r]:self.phi_indptr[r + 1]].tolist(),
+                        self.phi_data[self.phi_indptr[r]:self.phi_indptr[r + 1]].tolist())
+            else:
+                pass
+        return event2feats
@@ -1,3 +1,5 @@
+import os
+import hashlib
 import numpy as np
 from six.moves import cPickle
 import copy
@@ -10,6 +12,45 @@ def save_obj(obj, path):
     cPickle.dump(obj, f, protocol=cPickle.HIGHEST_PROTOCOL)
     f.close()
 
+def save_atomic(save_func, obj, path):
+    #write to a temp file and rename, parallel sweep jobs may race on the same cache file
+    tmp_path = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        save_func(obj, tmp_path)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        else:
+            pass
+        return False #read-only data dir
+    return True
+
+def save_npy(arr, path):
+    f = open(path, 'wb')
+    np.save(f, arr)
+    f.close()
+
+def source_stamp(path, with_hash = True):
+    st = os.stat(path)
+    h = hashlib.md5(open(path, 'rb').read()).hexdigest() if with_hash else None
+    return (st.st_size, st.st_mtime, h)
+
+def is_fresh(stamps, sources):
+    if len(stamps) != len(sources):
+        return False
+    for (size, mtime, h), path in zip(stamps, sources):
+        cur_size, cur_mtime, _ = source_stamp(path, with_hash = False)
+        if cur_size != size:
+            return False
+        elif cur_mtime == mtime:
+            pass
+        elif source_stamp(path)[2] != h:
+            return False #touched and changed, only the hash can tell
+        else:
+            pass
+    return True
+
 
 def rargmax(vec):
     assert len(vec.shape) == 1
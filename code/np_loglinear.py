@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+import numpy as np
+import json
+import theano
+
+__author__ = 'arenduchintala'
+
+if theano.config.floatX == 'float32':
+    intX = np.int32
+    floatX = np.float32
+else:
+    intX = np.int64
+    floatX = np.float64
+
+TOP_K_TIE_TOL = 1e-4 #same as recurrent_loglinear.TOP_K_TIE_TOL
+
+
+def sigmoid(a):
+    return 1.0 / (1.0 + np.exp(-a))
+
+
+class NumpyLoglinear(object):
+    #numpy copy of RecurrentLoglinear's single step functions (get_step_y_hat, get_step_y_hats, get_step_transition)
+    #for the RL drivers, which call them one action at a time. nothing is compiled, params are fixed.
+    #phi is the per x compacted block of DataHelper.load_phi_active so a step only touches the k_x features of x,
+    #or with a binary phi (DataHelper phi_type "binary") the per (x, e) feature id lists, so a score is a sum of theta
+    def __init__(self, dh, grad_transform = "0", grad_model = "g0", learning_model = "m1", clip = False, grad_top_k = "top_all", saved_weights = None, params = None):
+        self.dh = dh
+        self.learning_model = learning_model
+        self.grad_model = grad_model
+        self.grad_transform = grad_transform
+        self.grad_top_k = grad_top_k
+        self.clip = clip
+        self.context_size = 10
+        self.saved_weights = saved_weights
+        self._eps = np.finfo(np.float32).eps
+        if params is None:
+            params = [floatX(np.asarray(i)) for i in json.loads(open(saved_weights, 'r').read())]
+        else:
+            pass
+        self.params = [floatX(np.asarray(p)) for p in params]
+        if self.learning_model not in ["m0", "m1", "m3", "m4"]:
+            raise BaseException("unknown learning model")
+        elif self.grad_model not in ["g0", "g1", "g2", "g3"]:
+            raise BaseException("unknown grad model")
+        elif self.grad_transform not in ["0", "norm", "sign"]:
+            raise BaseException("unknown user ul")
+        elif not self.grad_top_k.startswith("top_"):
+            raise BaseException("unknown grad top k")
+        elif self.dh.phi_type == "lowrank":
+            raise BaseException("numpy engine scores with the exact phi, it can not stand in for a lowrank phi model")
+        else:
+            pass
+        if self.dh.phi_bin_idx is not None:
+            self.bin_idx = np.asarray(self.dh.phi_bin_idx, dtype=np.int32) #(F, E, L)
+        else:
+            self.bin_idx = None
+            if self.dh.phi_active is None:
+                active_idx, phi_active = self.dh.load_phi_active()
+            else:
+                active_idx, phi_active = self.dh.phi_active_idx, self.dh.phi_active
+            self.active_idx = np.asarray(active_idx, dtype=np.int32) #(F, K)
+            self.phi_active = np.asarray(phi_active, dtype=floatX) #(F, E, K)
+            #padding repeats column 0 after the sorted active columns, so k_x is 1 + the non-zero ids after the first
+            self.active_len = 1 + np.count_nonzero(self.active_idx[:, 1:], axis=1)
+        #m0 and m1 gates do not depend on the context, compute them once
+        self.fixed_gates = self.gates(None, None) if self.learning_model in ["m0", "m1"] else None
+        #m3 and m4 gates only depend on (c_t, c_tm1), which take a handful of distinct values (prompt type x feedback x chance),
+        #so they are computed once per distinct pair and looked up after that
+        self.gate_table = {}
+
+    def get_params(self):
+        return self.params
+
+    def pad_theta(self, theta):
+        return np.append(theta, floatX(0.0)) #the binary phi pads its id lists with FEAT_SIZE
+
+    def phi_score(self, x_t, theta):
+        if self.bin_idx is not None:
+            return np.sum(self.pad_theta(theta)[self.bin_idx[x_t]], axis=1) #(Y,)
+        else:
+            pass
+        k = self.active_len[x_t]
+        return self.phi_active[x_t, :, :k].dot(theta[self.active_idx[x_t, :k]]) #(Y,)
+
+    def phi_project(self, x_t, w):
+        if self.bin_idx is not None:
+            bin_idx = self.bin_idx[x_t]
+            g = np.bincount(bin_idx.ravel(), weights=np.repeat(w, bin_idx.shape[1]), minlength=self.dh.FEAT_SIZE + 1)
+            return g[:self.dh.FEAT_SIZE].astype(floatX)
+        else:
+            pass
+        k = self.active_len[x_t]
+        g = np.zeros(self.dh.FEAT_SIZE, dtype=floatX)
+        g[self.active_idx[x_t, :k]] = w.dot(self.phi_active[x_t, :, :k]) #(Y,) dot (Y,k)
+        return g
+
+    def softmax(self, y_dot, o):
+        y_dot = np.where(o != 0, y_dot, floatX(-1e8)).astype(floatX)
+        e = np.exp(y_dot - np.max(y_dot, axis=-1, keepdims=True))
+        y_hat = e / np.sum(e, axis=-1, keepdims=True)
+        return np.clip(y_hat, floatX(self._eps), floatX(1.0 - self._eps))
+
+    def obs_model(self, x_t, o_t, theta_tm1):
+        return self.softmax(self.phi_score(x_t, theta_tm1), o_t) #(Y,)
+
+    def get_step_y_hat(self, x_t, o_t, theta_tm1):
+        return np.reshape(self.obs_model(x_t, o_t, theta_tm1), (1, self.dh.E_SIZE))
+
+    def get_step_y_hats(self, xs, os, theta_tm1):
+        #every row of an action table at once, padded slots have phi 0 so the full K block can be used
+        if self.bin_idx is not None:
+            y_dot = np.sum(self.pad_theta(theta_tm1)[self.bin_idx[xs]], axis=2) #(A,Y,L) -> (A,Y)
+        else:
+            y_dot = np.einsum('ayk,ak->ay', self.phi_active[xs], theta_tm1[self.active_idx[xs]])
+        return self.softmax(y_dot, os) #(A,Y)
+
+    def create_target(self, y_selected, y_predicted, feedback):
+        if feedback[4]:
+            return y_predicted
+        elif feedback[3]:
+            return y_selected
+        else:
+            y_rev_predicted = y_predicted * (1.0 - y_selected)
+            return y_rev_predicted / np.sum(y_rev_predicted)
+
+    def compute_update(self, x_t, y_hat, y_t, c_t, merge):
+        if self.grad_model == "g0":
+            y_target = self.create_target(y_t, y_hat, c_t)
+            theta_t_grad = self.phi_project(x_t, y_target - y_hat)
+        elif self.grad_model == "g1":
+            theta_t_grad = self.phi_project(x_t, y_t - y_hat)
+            theta_t_grad = -theta_t_grad if c_t[5] == 1.0 else theta_t_grad
+        elif self.grad_model == "g2":
+            pos_theta_t_grad = self.phi_project(x_t, y_t - y_hat)
+            if c_t[5] == 1.0:
+                y_target = self.create_target(y_t, y_hat, c_t)
+                redistribute_theta_t_grad = self.phi_project(x_t, y_target - y_hat)
+                theta_t_grad = merge * -pos_theta_t_grad + (1.0 - merge) * redistribute_theta_t_grad
+            else:
+                theta_t_grad = pos_theta_t_grad
+        else:
+            y_t_idx = np.argmax(y_t)
+            Phi_x_y = self.phi_project(x_t, (np.arange(self.dh.E_SIZE) == y_t_idx).astype(floatX))
+            theta_t_grad = Phi_x_y if c_t[5] == 1.0 else -Phi_x_y
+            theta_t_grad = theta_t_grad / np.sum(theta_t_grad)
+
+        if self.grad_transform == "norm":
+            theta_t_grad = theta_t_grad / np.sqrt(np.sum(np.square(self._eps + theta_t_grad)))
+        elif self.grad_transform == "sign":
+            theta_t_grad = floatX(0.01) * np.sign(theta_t_grad)
+        else:
+            pass
+        if self.grad_top_k != "top_all":
+            #same selection as RecurrentLoglinear: the k largest |update|, ties at the k-th go to the lowest index
+            k = min(int(self.grad_top_k.split("_")[1]), self.dh.FEAT_SIZE)
+            abs_grad = np.abs(theta_t_grad.astype(floatX))
+            kth = np.partition(abs_grad, self.dh.FEAT_SIZE - k)[self.dh.FEAT_SIZE - k]
+            above = abs_grad > kth * floatX(1.0 + TOP_K_TIE_TOL)
+            tied = (abs_grad >= kth * floatX(1.0 - TOP_K_TIE_TOL)) & ~above
+            keep = above | (tied & (np.cumsum(tied) <= k - np.count_nonzero(above)))
+            theta_t_grad = np.where(keep, theta_t_grad, 0)
+        else:
+            pass
+        return theta_t_grad.astype(floatX)
+
+    def gates(self, c_t, c_tm1):
+        if self.learning_model == "m0":
+            W_r, W_z = self.params[:2]
+            return sigmoid(W_r), sigmoid(W_z)
+        elif self.learning_model == "m1":
+            W_r, W_z, b_z, b_r = self.params[:4]
+            return sigmoid(W_r + b_r), sigmoid(W_z + b_z)
+        elif self.learning_model == "m3":
+            W_zc, W_rc, W_zc2, W_rc2, b_z, b_r = self.params[:6]
+            return sigmoid(W_rc.dot(W_rc2.dot(c_tm1)) + b_r), sigmoid(W_zc.dot(W_zc2.dot(c_t)) + b_z)
+        else:
+            W_zc, W_rc, b_z, b_r = self.params[:4]
+            return sigmoid(W_rc.dot(c_tm1) + b_r), sigmoid(W_zc.dot(c_t) + b_z)
+
+    def context_gates(self, c_t, c_tm1):
+        key = (c_t.astype(floatX).tobytes(), c_tm1.astype(floatX).tobytes())
+        if key not in self.gate_table:
+            self.gate_table[key] = self.gates(c_t, c_tm1)
+        else:
+            pass
+        return self.gate_table[key]
+
+    def get_step_transition(self, x_t, y_t, o_t, s_t, s_tm1, theta_tm1, merge = 1.0):
+        c_t = np.reshape(s_t[:10], (self.context_size,))
+        c_tm1 = np.reshape(s_tm1[:10], (self.context_size,))
+        y_hat = self.obs_model(x_t, o_t, theta_tm1)
+        update_t = self.compute_update(x_t, y_hat, y_t, c_t, merge)
+        g_r, g_z = self.context_gates(c_t, c_tm1) if self.fixed_gates is None else self.fixed_gates
+        if c_t[6] == 1.0:
+            theta_t = theta_tm1 #no feedback, theta does not change
+        else:
+            theta_t = g_r * theta_tm1 + g_z * update_t
+        if self.clip:
+            theta_t = np.clip(theta_t, -1.0, 1.0)
+        else:
+            pass
+        theta_t = theta_t * (np.abs(theta_t) > self._eps)
+        g_r = g_r * (np.abs(g_r) > self._eps)
+        g_z = g_z * (np.abs(g_z) > self._eps)
+        return [np.asarray(theta_t, dtype=floatX), np.asarray(g_r, dtype=floatX), np.asarray(g_z, dtype=floatX)]
+
+
+def from_recurrent_loglinear(rll):
+    return NumpyLoglinear(rll.dh,
+            grad_transform = rll.grad_transform,
+            grad_model = rll.grad_model,
+            learning_model = rll.learning_model,
+            clip = rll.clip,
+            grad_top_k = rll.grad_top_k,
+            saved_weights = rll.saved_weights,
+            params = [p.get_value() for p in rll.params])
+
+
+def compare_to_theano(nll, rll, steps = 100, seed = 1234):
+    #walks random actions through both models, feeding both the theano theta, and returns the
+    #largest absolute differences in y_hat, theta_t, g_r and g_z
+    rs = np.random.RandomState(seed)
+    dh = rll.dh
+    theta_tm1 = floatX(0.1 * rs.randn(dh.FEAT_SIZE))
+    c_tm1 = np.zeros(10, dtype=floatX)
+    diffs = np.zeros(4)
+    for _ in xrange(steps):
+        a_idx = rs.randint(len(dh.actions))
+        x_t, o_t = dh.action_xs[a_idx], dh.action_options[a_idx]
+        c_t = dh.action_types[a_idx].copy()
+        y_hat = rll.get_step_y_hat(x_t, o_t, theta_tm1)
+        diffs[0] = max(diffs[0], np.max(np.abs(y_hat - nll.get_step_y_hat(x_t, o_t, theta_tm1))))
+        y_sel = rs.choice(dh.E_SIZE, p = o_t / np.sum(o_t))
+        if not c_t[[0, 3]].any():
+            c_t[4] = 1 if y_sel == dh.action_yts[a_idx] else 0
+            c_t[5] = 1 - c_t[4]
+        else:
+            pass
+        y_t = np.zeros(dh.E_SIZE, dtype=floatX)
+        y_t[y_sel] = 1.0
+        out = rll.get_step_transition(x_t, y_t, o_t, c_t, c_tm1, theta_tm1)
+        n_out = nll.get_step_transition(x_t, y_t, o_t, c_t, c_tm1, theta_tm1)
+        for i in xrange(3):
+            diffs[i + 1] = max(diffs[i + 1], np.max(np.abs(out[i] - n_out[i])))
+        theta_tm1, c_tm1 = out[0], c_t
+    return diffs
+
+
+class NumpyRecurrentLoglinear(NumpyLoglinear):
+    #numpy training backend for the m0 and m1 models with g0 or g1 updates (grad_transform "0", top_all, full softmax).
+    #the loss of a user and its gradient wrt the gate params are worked out by hand: a forward pass over the user's events
+    #keeps theta_tm1 and the softmax output of every step, a reverse sweep carries dloss/dtheta_t back to theta_0 and
+    #sums the gate gradients on the way. nothing is compiled, rmsprop is the same step as code/optimizers.py
+    def __init__(self, dh, grad_transform = "0", grad_model = "g0", learning_model = "m1", clip = False, grad_top_k = "top_all", reg = 0.1, saved_weights = None, params = None):
+        NumpyLoglinear.__init__(self, dh, grad_transform = grad_transform, grad_model = grad_model, learning_model = learning_model, clip = clip, grad_top_k = grad_top_k, saved_weights = saved_weights, params = params)
+        if self.learning_model not in ["m0", "m1"]:
+            raise BaseException("numpy backend only has the m0 and m1 models")
+        elif self.grad_model not in ["g0", "g1"]:
+            raise BaseException("numpy backend only has the g0 and g1 grad models")
+        elif self.grad_transform != "0":
+            raise BaseException("numpy backend only has grad transform 0")
+        elif self.grad_top_k != "top_all":
+            raise BaseException("numpy backend only has grad top k top_all")
+        else:
+            pass
+        self.l = reg
+        self.reg_params = [0, 1] #W_r, W_z
+        self.accu = [np.zeros_like(p) for p in self.params] #rmsprop state
+
+    def forward(self, X, Y, O, S, theta_0):
+        #thetas[t] is theta_tm1 of step t, thetas[-1] the theta after the last event
+        n = X.shape[0]
+        g_r, g_z = self.fixed_gates
+        thetas = np.empty((n + 1, self.dh.FEAT_SIZE), dtype=floatX)
+        thetas[0] = theta_0
+        p = np.empty((n, self.dh.E_SIZE), dtype=floatX) #softmax before the clip
+        in_clip = np.ones((n, self.dh.FEAT_SIZE), dtype=bool) if self.clip else None
+        for t in xrange(n):
+            c_t = S[t, :10]
+            y_dot = np.where(O[t] != 0, self.phi_score(X[t], thetas[t]), floatX(-1e8))
+            e = np.exp(y_dot - np.max(y_dot))
+            p[t] = e / np.sum(e)
+            if c_t[6] == 1.0:
+                theta_t = thetas[t]
+            else:
+                y_hat = np.clip(p[t], floatX(self._eps), floatX(1.0 - self._eps))
+                theta_t = g_r * thetas[t] + g_z * self.compute_update(X[t], y_hat, Y[t], c_t, 1.0)
+            if self.clip:
+                in_clip[t] = np.abs(theta_t) <= 1.0
+                theta_t = np.clip(theta_t, -1.0, 1.0)
+            else:
+                pass
+            thetas[t + 1] = theta_t
+        y_hats = np.clip(p, floatX(self._eps), floatX(1.0 - self._eps))
+        #c and ic losses (get_eval's model_loss), a step that is both is counted twice as in the theano graph
+        w = np.any(S[:, [4, 7]], axis=1).astype(floatX) + np.any(S[:, [5, 8]], axis=1).astype(floatX)
+        losses = -np.sum(Y * np.log(y_hats), axis=1)
+        return thetas, p, y_hats, w, losses, in_clip
+
+    def reg_loss(self):
+        return sum([np.sum(np.abs(self.params[i] + self._eps)) + np.sum(np.square(self.params[i])) for i in self.reg_params])
+
+    def get_loss_grads(self, X, Y, O, S, theta_0):
+        #total loss (as RecurrentLoglinear's total_loss) and its gradient wrt each of self.params
+        thetas, p, y_hats, w, losses, in_clip = self.forward(X, Y, O, S, theta_0)
+        g_r, g_z = self.fixed_gates
+        G = np.zeros(self.dh.FEAT_SIZE, dtype=floatX) #dloss/dtheta_t
+        d_g_r = np.zeros(self.dh.FEAT_SIZE, dtype=floatX)
+        d_g_z = np.zeros(self.dh.FEAT_SIZE, dtype=floatX)
+        eps = floatX(self._eps)
+        for t in xrange(X.shape[0] - 1, -1, -1):
+            x_t, y_t, c_t = X[t], Y[t], S[t, :10]
+            if self.clip:
+                G = G * in_clip[t]
+            else:
+                pass
+            d_y_hat = -w[t] * y_t / y_hats[t]
+            if c_t[6] == 1.0:
+                d_theta = G
+            else:
+                d_theta = g_r * G
+                d_g_r += G * thetas[t]
+                d_g_z += G * self.compute_update(x_t, y_hats[t], y_t, c_t, 1.0)
+                d_v = self.phi_score(x_t, g_z * G) #back through update = v dot Phi_x_t, (Y,)
+                if self.grad_model == "g1":
+                    d_y_hat -= -d_v if c_t[5] == 1.0 else d_v
+                elif c_t[4]:
+                    pass #the target is y_hat itself, the update is 0
+                elif c_t[3]:
+                    d_y_hat -= d_v
+                else:
+                    #target = y_hat * (1 - y_t) / sum(y_hat * (1 - y_t))
+                    y_rev = y_hats[t] * (1.0 - y_t)
+                    y_rev_sum = np.sum(y_rev)
+                    d_y_hat += (d_v - d_v.dot(y_rev / y_rev_sum)) / y_rev_sum * (1.0 - y_t) - d_v
+            d_p = d_y_hat * ((p[t] >= eps) & (p[t] <= 1.0 - eps))
+            d_y_dot = p[t] * (d_p - d_p.dot(p[t]))
+            d_y_dot = np.where(O[t] != 0, d_y_dot, 0) #non-options are a constant -1e8
+            G = d_theta + self.phi_project(x_t, d_y_dot.astype(floatX))
+        d_pre_r = d_g_r * g_r * (1.0 - g_r)
+        d_pre_z = d_g_z * g_z * (1.0 - g_z)
+        if self.learning_model == "m0":
+            grads = [np.sum(d_pre_r), np.sum(d_pre_z)]
+        else:
+            grads = [d_pre_r, d_pre_z, np.sum(d_pre_z), np.sum(d_pre_r)] #W_r, W_z, b_z, b_r
+        for i in self.reg_params:
+            grads[i] = grads[i] + self.l * (np.sign(self.params[i] + self._eps) + 2.0 * self.params[i])
+        loss = np.sum(w * losses) + self.l * self.reg_loss()
+        return floatX(loss), [np.asarray(g, dtype=floatX) for g in grads]
+
+    def set_params(self, params):
+        self.params = [floatX(np.asarray(p)) for p in params]
+        self.fixed_gates = self.gates(None, None)
+
+    def rmsprop(self, grads, lr, rho = 0.9, epsilon = 1e-6):
+        for i, g in enumerate(grads):
+            self.accu[i] = (rho * self.accu[i] + (1 - rho) * g ** 2).astype(floatX)
+            self.params[i] = (self.params[i] - (lr * g / np.sqrt(self.accu[i] + epsilon))).astype(floatX)
+        #the m0 and m1 gates are fixed for a whole user, recomputed once per update
+        self.fixed_gates = self.gates(None, None)
+
+    def do_train(self, X, Y, YT, O, S, SM1, theta_0, lr):
+        #same call and outputs as RecurrentLoglinear.do_train, YT and SM1 are not used by m0/m1
+        loss, grads = self.get_loss_grads(X, Y, O, S, theta_0)
+        self.rmsprop(grads, lr)
+        non_finite = not (np.isfinite(loss) and all([np.all(np.isfinite(p)) for p in self.params]))
+        return loss, non_finite
+
+
+def numpy_trainer(rll):
+    #a NumpyRecurrentLoglinear that starts from rll's params, see RecurrentLoglinear.set_params to copy them back
+    return NumpyRecurrentLoglinear(rll.dh,
+            grad_transform = rll.grad_transform,
+            grad_model = rll.grad_model,
+            learning_model = rll.learning_model,
+            clip = rll.clip,
+            grad_top_k = rll.grad_top_k,
+            reg = rll.l,
+            params = [p.get_value() for p in rll.params])
+
+
+def check_gradients(nrl, rll, SEQ, users = 10, theta_0 = None):
+    #largest relative difference between the hand derived gradients and theano's (RecurrentLoglinear.get_grads)
+    #and the largest loss difference, over the first users of SEQ. both models need the same params
+    theta_0 = np.zeros(rll.dh.FEAT_SIZE, dtype=floatX) if theta_0 is None else theta_0
+    grad_diff, loss_diff = 0.0, 0.0
+    for idx in xrange(min(users, len(SEQ))):
+        X, Y, YT, O, S = SEQ[idx]
+        loss, grads = nrl.get_loss_grads(X, Y, O, S, theta_0)
+        t_out = rll.get_grads(X, Y, YT, O, S, S, theta_0) #m0/m1 do not read SM1
+        t_loss, t_grads = t_out[0], t_out[1:]
+        loss_diff = max(loss_diff, abs(loss - t_loss) / max(1.0, abs(t_loss)))
+        for g, t_g in zip(grads, t_grads):
+            grad_diff = max(grad_diff, np.max(np.abs(g - t_g)) / max(1e-3, np.max(np.abs(t_g))))
+    return grad_diff, loss_diff
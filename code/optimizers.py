@@ -7,14 +7,15 @@ import numpy as np
 dtype = theano.config.floatX
 
 
-def rmsprop(cost, params, learning_rate, rho=0.9, epsilon=1e-6):
+def rmsprop(cost, params, learning_rate, rho=0.9, epsilon=1e-6, grads=None):
+    # grads: gradients computed elsewhere (e.g. summed over worker processes), one per param, used instead of T.grad(cost)
     updates = list()
 
-    for param in params:
+    for i, param in enumerate(params):
         accu = theano.shared(np.zeros(param.get_value(borrow=True).shape, dtype=dtype),
                              broadcastable=param.broadcastable)
 
-        grad = T.grad(cost, param)
+        grad = T.grad(cost, param) if grads is None else grads[i]
         accu_new = rho * accu + (1 - rho) * grad ** 2
 
         updates.append((accu, accu_new))
@@ -22,20 +23,21 @@ def rmsprop(cost, params, learning_rate, rho=0.9, epsilon=1e-6):
 
     return updates
 
-def sgd(cost, params, learning_rate):
-    return [(param, param - learning_rate * T.grad(cost, param)) for param in params]
+def sgd(cost, params, learning_rate, grads=None):
+    grads = [T.grad(cost, param) for param in params] if grads is None else grads
+    return [(param, param - learning_rate * grad) for param, grad in zip(params, grads)]
 
-def momentum(cost, params, learning_rate, momentum=0.9, type='nesterov'):
+def momentum(cost, params, learning_rate, momentum=0.9, type='nesterov', grads=None):
     assert type in ['std', 'nesterov'], 'Possible momentum types: `std`, `nesterov`'
     assert 0 <= momentum < 1
     updates = list()
 
-    for param in params:
+    for i, param in enumerate(params):
         # this is the "momentum" part: it is shared across updates
         velocity = theano.shared(np.zeros(param.get_value(borrow=True).shape, dtype=dtype),
                                  broadcastable=param.broadcastable)
 
-        update = param - learning_rate * T.grad(cost, param)
+        update = param - learning_rate * (T.grad(cost, param) if grads is None else grads[i])
         if type == 'nesterov': # nesterov
             x = momentum * velocity + update - param
             updates.append((velocity, x))
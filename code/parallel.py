@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+import multiprocessing
+import numpy as np
+import theano
+from code.eval_tools import pad_start, disp_eval
+from code.np_loglinear import NumpyRecurrentLoglinear
+
+__author__ = 'arenduchintala'
+
+if theano.config.floatX == 'float32':
+    floatX = np.float32
+    intX = np.int32
+else:
+    floatX = np.float64
+    intX = np.int64
+
+#set in each worker by _init_worker. workers are forked, so the model (with its compiled get_grads) and the
+#training sequences are the parent's copy-on-write pages (or the shared memory map with read_data mmap=True)
+_worker = {}
+
+
+def _init_worker(model, SEQ):
+    _worker['model'] = model
+    _worker['SEQ'] = SEQ
+
+
+def user_grads(model, X, Y, YT, O, S, theta_0):
+    #total loss of one user and its gradient wrt each param, for a RecurrentLoglinear or the numpy backend
+    if isinstance(model, NumpyRecurrentLoglinear):
+        return model.get_loss_grads(X, Y, O, S, theta_0)
+    else:
+        out = model.get_grads(X, Y, YT, O, S, pad_start(S), theta_0)
+        return out[0], out[1:]
+
+
+def _sum_grads(args):
+    params, ids = args
+    model, SEQ = _worker['model'], _worker['SEQ']
+    model.set_params(params)
+    theta_0 = np.zeros((model.dh.FEAT_SIZE,)).astype(floatX)
+    loss, grads = 0.0, None
+    for idx in ids:
+        l, g = user_grads(model, *(list(SEQ[idx]) + [theta_0]))
+        loss += l
+        grads = g if grads is None else [a + b for a, b in zip(grads, g)]
+    return loss, grads
+
+
+class GradientPool(object):
+    #worker processes that each hold the model and the training sequences, grads(params, ids) splits the users ids
+    #over the workers, each sets params and sums the per user gradients of its share, and the sums are added up here.
+    #the sum over a minibatch is the gradient of the summed do_train losses of its users (as do_batch_train)
+    def __init__(self, model, SEQ, processes):
+        if not isinstance(model, NumpyRecurrentLoglinear):
+            model.get_grads #compiled once here, before the fork
+        else:
+            pass
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, _init_worker, (model, SEQ))
+
+    def grads(self, params, ids):
+        params = [np.asarray(p) for p in params]
+        shares = [s for s in np.array_split(np.asarray(ids), self.processes) if s.shape[0] > 0]
+        results = self.pool.map(_sum_grads, [(params, s) for s in shares])
+        loss = sum([r[0] for r in results])
+        grads = [np.sum([r[1][i] for r in results], axis=0).astype(floatX) for i in xrange(len(params))]
+        return loss, grads
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _init_eval_worker(model, dh, splits, pack):
+    _worker['model'] = model
+    _worker['dh'] = dh
+    _worker['splits'] = splits
+    _worker['pack'] = pack
+
+
+def _eval_split(args):
+    params, name, trace_file, epoch_idx = args
+    model = _worker['model']
+    model.set_params(params)
+    return disp_eval(_worker['splits'][name], model, _worker['dh'], trace_file, epoch_idx, pack = _worker['pack'])
+
+
+class EvalPool(object):
+    #worker processes that run disp_eval on named splits under a snapshot of the params, so the caller can go on
+    #training. submit returns at once, collect waits for (and returns) the disp_eval results of a submit in order
+    def __init__(self, model, dh, splits, processes, pack = 0):
+        model.get_params #compiled once here, before the fork
+        if pack > 0:
+            model.get_packed_eval
+        else:
+            model.get_eval
+        self.pool = multiprocessing.Pool(processes, _init_eval_worker, (model, dh, splits, pack))
+
+    def submit(self, params, epoch_idx, requests):
+        #requests is a list of (split name, trace_file or None)
+        params = [np.asarray(p) for p in params]
+        return [self.pool.apply_async(_eval_split, ((params, name, trace_file, epoch_idx),)) for name, trace_file in requests]
+
+    def collect(self, handle):
+        return [r.get() for r in handle]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
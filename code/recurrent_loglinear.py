@@ -4,6 +4,7 @@ import json
 from optimizers import rmsprop
 import theano
 import theano.tensor as T
+from theano.ifelse import ifelse
 
 __author__ = 'arenduchintala'
 
@@ -26,12 +27,28 @@ def ortho_weight(ndim):
     return u.astype(theano.config.floatX)
 """
 
+COMPILED_FUNCTIONS = ['get_step_y_hat', 'get_step_y_hats', 'get_step_transition', 'get_params',
+        'get_seq_losses', 'get_loss', 'get_seq_y_hats', 'get_seq_thetas', 'get_seq_updates', 'get_seq_g_r', 'get_seq_g_z',
+        'get_grads', 'apply_grads', 'get_eval', 'do_update', 'do_train', 'do_window_train', 'get_packed_eval', 'do_packed_update', 'do_packed_train',
+        'get_batch_loss', 'do_batch_update', 'do_batch_train']
+#columns of the event masks returned by get_eval
+EVAL_MASKS = ['guess', 'correct', 'incorrect', 'revealed', 'mc', 'tp']
+#relative distance to the k-th largest |update| that grad_top_k treats as a tie, features with equal weights can come out
+#a few bits apart depending on the summation order (same value in np_loglinear)
+TOP_K_TIE_TOL = 1e-4
+UPDATE_FUNCTIONS = ['apply_grads', 'do_update', 'do_train', 'do_window_train', 'do_packed_update', 'do_packed_train', 'do_batch_update', 'do_batch_train']
+_compiled_functions = {} #(config_key, name) -> (compiled function, the placeholder shared variables it reads)
+
+def placeholder_vars(shared_vars):
+    #tiny shared variables of the same types, the cached functions read these so the cache keeps no model's arrays alive
+    return [theano.shared(np.zeros((1,) * v.ndim, dtype=v.dtype), name=v.name, broadcastable=v.broadcastable) for v in shared_vars]
+
 class RecurrentLoglinear(object):
-    def __init__(self, dh, u = "rms", reg = 0.1, grad_transform= "0", grad_model = "g0", learning_model = "m1", clip = False, interpolate_bin_loss = 0, temp_model = "t0", grad_top_k = "top_all", saved_weights = None):
+    def __init__(self, dh, u = "rms", reg = 0.1, grad_transform= "0", grad_model = "g0", learning_model = "m1", clip = False, interpolate_bin_loss = 0, temp_model = "t0", grad_top_k = "top_all", saved_weights = None, batch_size = 1, softmax = "full"):
         self.dh = dh #DataHelper(event2feats_file, feat2id_file, actions_file)
         self.learning_model = learning_model
         self.grad_model = grad_model
-        self.low_rank = 100
+        self.low_rank = self.dh.low_rank #rank of phi with phi_type "lowrank", see DataHelper.load_phi_lowrank
         self.context_size = 10
         self.grad_top_k = grad_top_k
         self.clip = clip
@@ -43,13 +60,37 @@ class RecurrentLoglinear(object):
         self.temp = 1.0
         self.merge = 1.0
         self.saved_weights = saved_weights
+        self.batch_size = batch_size
+        self.softmax = softmax
+        self.max_options = self.dh.max_options #softmax="options": multiple choice steps take a softmax over this many scores
         assert 0 <= self.interpolate_bin_loss <= 1 
         assert self.use_sum_loss == 0 or self.use_sum_loss == 1
         self.grad_transform = grad_transform 
         self._eps = np.finfo(np.float32).eps #1e-10 # for fixing divide by 0
         self._mult_eps = np.finfo(np.float32).eps #1e-10 # for fixing divide by 0
         #self.phi = theano.shared(floatX(self.load_phi()), name='Phi') #(output_dim, feat_size)
-        self.phi = theano.shared(floatX(self.dh.phi), name='Phi') #(output_dim, feat_size)
+        if self.dh.phi_type == "dense":
+            #borrow, so a memory-mapped phi (DataHelper mmap=True) is not copied
+            self.phi = theano.shared(np.asarray(self.dh.phi, dtype=floatX), name='Phi', borrow=True) #(output_dim, feat_size)
+        elif self.dh.phi_type == "sparse":
+            #csr phi, rows keyed by (f, e) see DataHelper.load_phi_csr
+            self.phi_indptr = theano.shared(np.asarray(self.dh.phi_indptr, dtype=np.int32), name='Phi_indptr', borrow=True)
+            self.phi_indices = theano.shared(np.asarray(self.dh.phi_indices, dtype=np.int32), name='Phi_indices', borrow=True)
+            self.phi_data = theano.shared(np.asarray(self.dh.phi_data, dtype=floatX), name='Phi_data', borrow=True)
+            self.phi_rows = theano.shared(np.asarray(self.dh.phi_rows, dtype=np.int32), name='Phi_rows', borrow=True)
+        elif self.dh.phi_type == "active":
+            #per x compacted phi, only the k_x feature columns x touches see DataHelper.load_phi_active
+            self.phi_active_idx = theano.shared(np.asarray(self.dh.phi_active_idx, dtype=np.int32), name='Phi_active_idx', borrow=True)
+            self.phi_active = theano.shared(np.asarray(self.dh.phi_active, dtype=floatX), name='Phi_active', borrow=True)
+        elif self.dh.phi_type == "binary":
+            #per (x, e) ids of the features that are on, see DataHelper.load_phi_binary
+            self.phi_bin_idx = theano.shared(np.asarray(self.dh.phi_bin_idx, dtype=np.int32), name='Phi_bin_idx', borrow=True)
+        elif self.dh.phi_type == "lowrank":
+            #phi[x] ~= phi_u[x].dot(phi_v), scores and projections go through the rank r space
+            self.phi_u = theano.shared(np.asarray(self.dh.phi_u, dtype=floatX), name='Phi_u', borrow=True)
+            self.phi_v = theano.shared(np.asarray(self.dh.phi_v, dtype=floatX), name='Phi_v', borrow=True)
+        else:
+            raise BaseException("unknown phi type")
         if self.learning_model == "m0":
             #scalar retention and update gate
             if saved_weights is None:
@@ -169,7 +210,74 @@ class RecurrentLoglinear(object):
             self.b_m = theano.shared(floatX(1.0), name = 'b_m')
         else:
             raise BaseException("unknown grad model")
-        self.make_graph()
+        if self.softmax not in ["full", "options"]:
+            raise BaseException("unknown softmax")
+        else:
+            pass
+        if self.batch_size > 1 and self.dh.phi_type not in ["dense", "active"]:
+            raise BaseException("batched training needs a dense or active phi")
+        else:
+            pass
+        self._fn_specs = {} #filled by make_graph, which runs on the first compile_function call that misses the cache
+
+    def __getattr__(self, name):
+        #only reached when name is not set yet, i.e. a theano function that has not been compiled
+        if name in COMPILED_FUNCTIONS:
+            f = self.compile_function(name)
+            setattr(self, name, f)
+            return f
+        else:
+            raise AttributeError(name)
+
+    def __getstate__(self):
+        #the graph builders are closures and cannot be pickled, drop them with the compiled functions, both are rebuilt on first use
+        state = dict([(k, v) for k, v in self.__dict__.iteritems() if k not in COMPILED_FUNCTIONS])
+        state['_fn_specs'] = {}
+        return state
+
+    def shared_vars(self):
+        #every shared variable the compiled functions read, in an order that is the same for instances with the same config
+        names = ['b_m', 'b_temp', 'phi', 'phi_indptr', 'phi_indices', 'phi_data', 'phi_rows', 'phi_active_idx', 'phi_active', 'phi_bin_idx', 'phi_u', 'phi_v']
+        return self.params + [self.__dict__[n] for n in names if n in self.__dict__]
+
+    def config_key(self):
+        #everything make_graph bakes into the graphs as a constant or a python branch
+        shapes = tuple([v.get_value(borrow=True).shape for v in self.shared_vars()])
+        return (self.learning_model, self.grad_model, self.grad_transform, self.grad_top_k, bool(self.clip),
+                self.temp_model, self.l, self.use_sum_loss, self.interpolate_bin_loss, self.batch_size, self.softmax, self.max_options,
+                self.dh.phi_type, self.dh.E_SIZE, self.dh.F_SIZE, self.dh.FEAT_SIZE, self.context_size, shapes, theano.config.floatX)
+
+    def compile_function(self, name):
+        #functions without updates are compiled once per config and copied for other instances with their own
+        #shared variables swapped in, so loading many saved models costs one compile per function.
+        #functions with updates own optimizer state and are compiled per instance
+        key = (self.config_key(), name)
+        if key in _compiled_functions:
+            f, f_vars = _compiled_functions[key]
+            f_inputs = [i.variable for i in f.maker.inputs]
+            swap = dict([(v_old, v_new) for v_old, v_new in zip(f_vars, self.shared_vars()) if v_old in f_inputs])
+            return f.copy(swap = swap) if len(swap) > 0 else f
+        else:
+            pass
+        if len(self._fn_specs) == 0:
+            self.make_graph()
+        else:
+            pass
+        f = self._fn_specs[name]()
+        if name not in UPDATE_FUNCTIONS:
+            #shared variables are matched by their position in shared_vars()
+            f_vars = placeholder_vars(self.shared_vars())
+            f_inputs = [i.variable for i in f.maker.inputs]
+            swap = dict([(v_old, v_new) for v_old, v_new in zip(self.shared_vars(), f_vars) if v_old in f_inputs])
+            f_cached = f.copy(swap = swap) if len(swap) > 0 else f
+            if len(swap) > 0 and hasattr(f_cached.maker.fgraph, 'checkpoint'):
+                f_cached.maker.fgraph.checkpoint() #drops the undo history of the swap, it holds this instance's variables
+            else:
+                pass
+            _compiled_functions[key] = (f_cached, f_vars)
+        else:
+            pass
+        return f
 
     def describe(self):
         print "model", self.learning_model, "grad_model", self.grad_model
@@ -187,6 +295,27 @@ class RecurrentLoglinear(object):
                 p[f_idx, e_idx, :]  = self._phi(f_idx, e_idx)
         return p
 
+    def train_function(self, inputs, loss, checks, lr, extra = []):
+        #training step that returns only the loss and a flag that is 1 when the loss, any of checks or
+        #any updated param is nan or inf (then any extra outputs), so nothing of size (T, D) is copied back per call
+        updates = self._update(loss, self.params, lr)
+        param_ids = set([id(p) for p in self.params])
+        new_params = [new_p for p, new_p in updates if id(p) in param_ids]
+        non_finite = T.any(T.stack([T.any(T.isnan(v) | T.isinf(v)) for v in [loss] + checks + extra + new_params]))
+        return theano.function(inputs, outputs = [loss, non_finite] + extra, updates = updates)
+
+    def apply_grads_function(self):
+        #an optimizer step (self._update) from gradients given as inputs, e.g. summed over the users of a
+        #minibatch by code/parallel.GradientPool, one input per param then the learning rate
+        lr = T.scalar('lr', dtype=theano.config.floatX)
+        grads = [p.type() for p in self.params]
+        return theano.function(grads + [lr], outputs = [], updates = self._update(None, self.params, lr, grads = grads))
+
+    def set_params(self, params):
+        #e.g. the params of a numpy backend (np_loglinear.NumpyRecurrentLoglinear) after training with it
+        for p, v in zip(self.params, params):
+            p.set_value(np.asarray(v, dtype=floatX))
+
     def save_weights(self, save_path):
         #_tmp_params = self.get_params()
         #print '_params in save', _tmp_params
@@ -205,6 +334,7 @@ class RecurrentLoglinear(object):
         YT = T.ivector('YT') #(sequence_size,) #index of the input string
         S = T.fmatrix('S') #(sequence_size,self.context_size) # was the answer marked as correct or incorrect?
         SM1 = T.fmatrix('SM1') #(sequence_size,self.context_size) # was the answer marked as correct or incorrect?
+        R = T.fvector('R') #(sequence_size,) 1.0 at the first event of each user of a packed sequence, see PackedSeqs.resets
         theta_0 = T.fvector('theta_0') #(feature_size,)
         _x_t = T.iscalar('_x_t')
         _y_t = T.fvector('_y_t')
@@ -213,6 +343,14 @@ class RecurrentLoglinear(object):
         _s_t = T.fvector('_s_t')
         _s_tm1 = T.fvector('_s_tm1')
         _theta_tm1 = T.fvector('_theta_tm1')
+        _xs = T.ivector('_xs') #(num_actions,)
+        _os = T.fmatrix('_os') #(num_actions, output_dim)
+
+        #the step helpers below also take a batch of users (the batched graph at the end of make_graph), x_t is then (B,) instead of
+        #a scalar, y_t, o_t, y_hat (B,Y), c_t (B,10) and theta (B,D)
+        def flag(c_t, i):
+            #context flag i, a (B,1) column for a batch so it broadcasts over each user's row
+            return c_t[i] if c_t.ndim == 1 else c_t[:, i].dimshuffle(0, 'x')
 
         def create_target(y_selected, y_predicted, feedback):
             #y_selected is a one-hot vector
@@ -221,8 +359,8 @@ class RecurrentLoglinear(object):
             y_neg_selected = -(y_selected - 1.0)  #flips 1s to 0s and 0s to 1s
             y_rev_predicted = y_predicted * y_neg_selected
             y_rev_predicted = y_rev_predicted / y_rev_predicted.sum(axis=1)[:, np.newaxis]
-            y_target = T.switch(feedback[3], y_selected, y_rev_predicted) #if answer revealed then y_selected else it can be correct or incorrect
-            y_target = T.switch(feedback[4], y_predicted, y_target) #if correct return predicted, else return target (which is now incorrect)
+            y_target = T.switch(flag(feedback, 3), y_selected, y_rev_predicted) #if answer revealed then y_selected else it can be correct or incorrect
+            y_target = T.switch(flag(feedback, 4), y_predicted, y_target) #if correct return predicted, else return target (which is now incorrect)
             return y_target 
 
         def masked(a, mask, val):
@@ -241,18 +379,159 @@ class RecurrentLoglinear(object):
             ic_loss_t = T.switch(T.any(c_t[[5,8]]), loss_t, 0)
             return r_loss_t, c_loss_t, ic_loss_t #, bin_loss_t
 
-        def obs_model(x_t, o_t, theta_tm1):
-            Phi_x_t = self.phi[x_t, :, :] #(1, Y, D)
-            Phi_x_t = T.reshape(Phi_x_t, (self.dh.E_SIZE, self.dh.FEAT_SIZE)) #(Y,D)
-            y_dot = Phi_x_t.dot(theta_tm1.T) #(Y,D,) dot (D,)
+        def phi_x(x_t):
+            if self.dh.phi_type == "dense" and x_t.ndim == 1:
+                return self.phi[x_t] #(B,Y,D)
+            elif self.dh.phi_type == "active" and x_t.ndim == 1:
+                return self.phi_active_idx[x_t], self.phi_active[x_t] #(B,K) and (B,Y,K)
+            elif self.dh.phi_type == "dense":
+                Phi_x_t = self.phi[x_t, :, :] #(1, Y, D)
+                Phi_x_t = T.reshape(Phi_x_t, (self.dh.E_SIZE, self.dh.FEAT_SIZE)) #(Y,D)
+                return Phi_x_t
+            elif self.dh.phi_type == "sparse":
+                start = self.phi_indptr[x_t * self.dh.E_SIZE]
+                end = self.phi_indptr[(x_t + 1) * self.dh.E_SIZE]
+                return self.phi_indices[start:end], self.phi_data[start:end], self.phi_rows[start:end] #(nnz_x,)
+            elif self.dh.phi_type == "active":
+                idx = self.phi_active_idx[x_t] #(K,)
+                Phi_x_t = T.reshape(self.phi_active[x_t], (self.dh.E_SIZE, self.dh.phi_active.shape[2])) #(Y,K)
+                return idx, Phi_x_t
+            elif self.dh.phi_type == "binary":
+                return T.reshape(self.phi_bin_idx[x_t], (self.dh.E_SIZE, self.dh.phi_bin_idx.shape[2])) #(Y,L)
+            elif self.dh.phi_type == "lowrank":
+                return T.reshape(self.phi_u[x_t], (self.dh.E_SIZE, self.dh.phi_u.shape[2])) #(Y,r)
+            else:
+                raise BaseException("unknown phi type")
+
+        def batch_flat(idx, width):
+            #ids of each row's columns idx (B,K) in a flattened (B,width) matrix. gathers and scatters go through these 1-d ids,
+            #theano has C code for 1-d advanced indexing while the 2-d a[rows, idx] form runs in python
+            return (T.arange(idx.shape[0]).dimshuffle(0, 'x') * width + idx).flatten()
+
+        def batch_take(a, idx):
+            #a[rows, idx], each row's own columns of a (B,W), (B,K)
+            return T.reshape(a.flatten()[batch_flat(idx, a.shape[1])], idx.shape)
+
+        def batch_add(a, idx, val):
+            #a (B,W) with val (B,K) added at each row's columns idx
+            return T.reshape(T.inc_subtensor(a.flatten()[batch_flat(idx, a.shape[1])], val.flatten()), a.shape)
+
+        def batch_rows_of(table, x_t, o_ids):
+            #table[x_t[b], o_ids[b]] of a (F,Y,W) table for x_t (B,) and o_ids (B,P), (B,P,W)
+            rows = T.reshape(table, (table.shape[0] * table.shape[1], table.shape[2]))
+            return T.reshape(rows[(x_t.dimshuffle(0, 'x') * table.shape[1] + o_ids).flatten()], (o_ids.shape[0], o_ids.shape[1], table.shape[2]))
+
+        def pad_theta(theta):
+            #theta with a 0 appended at FEAT_SIZE, the padding id of the binary phi
+            return T.concatenate([theta, T.zeros((1,), dtype=theta.dtype)])
+
+        def phi_score(x_t, theta):
+            #Phi_x_t dot theta, (Y,)
+            if self.dh.phi_type == "dense" and x_t.ndim == 1:
+                return T.batched_dot(phi_x(x_t), theta) #(B,Y,D) dot (B,D)
+            elif self.dh.phi_type == "active" and x_t.ndim == 1:
+                idx, Phi_x_t = phi_x(x_t)
+                return T.batched_dot(Phi_x_t, batch_take(theta, idx)) #(B,Y,K) dot (B,K)
+            elif self.dh.phi_type == "dense":
+                Phi_x_t = phi_x(x_t)
+                return Phi_x_t.dot(theta.T) #(Y,D,) dot (D,)
+            elif self.dh.phi_type == "active":
+                idx, Phi_x_t = phi_x(x_t)
+                return Phi_x_t.dot(theta[idx]) #(Y,K) dot (K,)
+            elif self.dh.phi_type == "binary":
+                return pad_theta(theta)[phi_x(x_t)].sum(axis=1) #sum of theta over the features on for each y
+            elif self.dh.phi_type == "lowrank":
+                return phi_x(x_t).dot(self.phi_v.dot(theta)) #(Y,r) dot ((r,D) dot (D,))
+            else:
+                idx, val, row = phi_x(x_t)
+                return T.inc_subtensor(T.zeros((self.dh.E_SIZE,))[row], val * theta[idx])
+
+        def phi_project(x_t, w, compact = False):
+            #w dot Phi_x_t, (D,) or (1,D) when w is (1,Y)
+            #compact=True (active phi only) leaves it on the K active columns of x_t, i.e. (K,)
+            if self.dh.phi_type == "dense" and x_t.ndim == 1:
+                return T.batched_dot(w, phi_x(x_t)) #(B,Y) dot (B,Y,D)
+            elif self.dh.phi_type == "active" and x_t.ndim == 1:
+                idx, Phi_x_t = phi_x(x_t)
+                return batch_add(T.zeros((idx.shape[0], self.dh.FEAT_SIZE)), idx, T.batched_dot(w, Phi_x_t)) #(B,Y) dot (B,Y,K)
+            elif self.dh.phi_type == "dense":
+                Phi_x_t = phi_x(x_t)
+                return w.dot(Phi_x_t)
+            elif self.dh.phi_type == "active":
+                idx, Phi_x_t = phi_x(x_t)
+                w = T.reshape(w, (self.dh.E_SIZE,))
+                if compact:
+                    return w.dot(Phi_x_t) #(K,)
+                else:
+                    pass
+                return T.inc_subtensor(T.zeros((self.dh.FEAT_SIZE,))[idx], w.dot(Phi_x_t)) #(Y,) dot (Y,K)
+            elif self.dh.phi_type == "binary":
+                bin_idx = phi_x(x_t)
+                w = T.reshape(w, (self.dh.E_SIZE,))
+                w_on = T.ones_like(bin_idx, dtype=theano.config.floatX) * w.dimshuffle(0, 'x') #(Y,L) w_y on every feature of y
+                return T.inc_subtensor(T.zeros((self.dh.FEAT_SIZE + 1,))[bin_idx.flatten()], w_on.flatten())[:self.dh.FEAT_SIZE]
+            elif self.dh.phi_type == "lowrank":
+                w = T.reshape(w, (self.dh.E_SIZE,))
+                return w.dot(phi_x(x_t)).dot(self.phi_v) #((Y,) dot (Y,r)) dot (r,D)
+            else:
+                idx, val, row = phi_x(x_t)
+                w = T.reshape(w, (self.dh.E_SIZE,))
+                return T.inc_subtensor(T.zeros((self.dh.FEAT_SIZE,))[idx], val * w[row])
+
+        def option_index(o):
+            #ids of the (at most max_options) options of each row of o (N,Y), and the number of options per row.
+            #rows with fewer options are filled with non-options, rows with more (TP "ALL") take the full softmax
+            o_ids = T.cast(T.argsort(-o, axis=1)[:, :self.max_options], 'int32') #(N,P)
+            return o_ids, T.sum(o, axis=1)
+
+        def phi_score_options(x_t, theta, o_ids):
+            #Phi_x_t dot theta on the option rows only, (P,)
+            if self.dh.phi_type == "dense" and x_t.ndim == 1:
+                return T.batched_dot(batch_rows_of(self.phi, x_t, o_ids), theta) #(B,P,D) dot (B,D)
+            elif self.dh.phi_type == "active" and x_t.ndim == 1:
+                return T.batched_dot(batch_rows_of(self.phi_active, x_t, o_ids), batch_take(theta, self.phi_active_idx[x_t])) #(B,P,K) dot (B,K)
+            elif self.dh.phi_type == "dense":
+                return self.phi[x_t][o_ids].dot(theta) #(P,D) dot (D,)
+            elif self.dh.phi_type == "binary":
+                return pad_theta(theta)[self.phi_bin_idx[x_t][o_ids]].sum(axis=1) #(P,L) -> (P,)
+            elif self.dh.phi_type == "lowrank":
+                return self.phi_u[x_t][o_ids].dot(self.phi_v.dot(theta)) #(P,r) dot (r,)
+            else:
+                idx = self.phi_active_idx[x_t]
+                return self.phi_active[x_t][o_ids].dot(theta[idx]) #(P,K) dot (K,)
+
+        def obs_model(x_t, o_t, theta_tm1, opts = None):
+            #opts=(o_ids, o_n) of this step from option_index, with softmax="options" a multiple choice step scores only its options
+            y_dot = phi_score(x_t, theta_tm1)
             y_dot_masked = masked(y_dot, o_t, -1e8) #(1,Y)
             y_hat_unsafe  = T.nnet.softmax(y_dot_masked) #(1,Y)
             #y_hat_unsafe  = softmax_temp(y_dot_masked) #T.nnet.softmax(y_dot_masked) #(1,Y)
+            if self.softmax == "options" and opts is not None and x_t.ndim == 1:
+                #a batch takes, per user, the options softmax on multiple choice steps and the full one on the rest
+                o_ids, o_n = opts #(B,P) and (B,)
+                o_dot = phi_score_options(x_t, theta_tm1, o_ids) #(B,P)
+                o_dot_masked = masked(o_dot, T.lt(T.arange(self.max_options).dimshuffle('x', 0), o_n.dimshuffle(0, 'x')), -1e8)
+                o_hat = T.nnet.softmax(o_dot_masked) #(B,P)
+                o_hat_unsafe = batch_add(T.zeros_like(y_hat_unsafe), o_ids, o_hat) #(B,Y) 0 off the options
+                y_hat_unsafe = T.switch(T.le(o_n, self.max_options).dimshuffle(0, 'x'), o_hat_unsafe, y_hat_unsafe)
+            elif self.softmax == "options" and opts is not None and self.dh.phi_type != "sparse":
+                o_ids, o_n = opts
+                o_dot = phi_score_options(x_t, theta_tm1, o_ids) #(P,)
+                o_dot_masked = masked(o_dot, T.lt(T.arange(self.max_options), o_n), -1e8)
+                o_hat = T.nnet.softmax(o_dot_masked) #(1,P)
+                o_hat_unsafe = T.set_subtensor(T.zeros_like(y_hat_unsafe)[0, o_ids], o_hat[0]) #(1,Y) 0 off the options
+                y_hat_unsafe = ifelse(T.le(o_n, self.max_options), o_hat_unsafe, y_hat_unsafe)
+            else:
+                pass
             y_hat = T.clip(y_hat_unsafe, floatX(self._eps), floatX(1.0 - self._eps))
-            return y_hat, Phi_x_t
+            return y_hat
 
         def compute_losses(y_hat, y_t): #, yt_t):
             #yt_t is only used for the binary loss mode.. 
+            if y_t.ndim == 2:
+                return -T.sum(y_t * T.log(y_hat), axis=1) #(B,)
+            else:
+                pass
             model_loss = -T.sum(y_t * T.log(y_hat)) 
             """
             m_t = T.argmax(y_hat) #model's prediction
@@ -272,29 +551,37 @@ class RecurrentLoglinear(object):
             """
             return model_loss #, model_bin_loss
 
-        def compute_update(x_t, y_hat, y_t, c_t, merge):
-            Phi_x_t = self.phi[x_t, :, :] #(1, Y, D)
-            Phi_x_t = T.reshape(Phi_x_t, (self.dh.E_SIZE, self.dh.FEAT_SIZE)) #(Y,D)
+        def compute_update(x_t, y_hat, y_t, c_t, merge, sparse = False):
+            #sparse=True returns (index, value) pairs instead of a (D,) vector: the top k with grad_top_k="top_K", and with an
+            #active phi the update is computed (and selected) on the K active columns of x_t only
+            compact = sparse and self.dh.phi_type == "active"
+            batch = x_t.ndim == 1
+            update_size = self.dh.phi_active.shape[2] if compact else self.dh.FEAT_SIZE
+            project = lambda w: phi_project(x_t, w, compact)
+            if compact and T.as_tensor_variable(merge).ndim == 1:
+                merge = merge[self.phi_active_idx[x_t]] #g2 merges per feature
+            else:
+                pass
             if self.grad_model == "g0":
                 #Redistribution update scheme
                 y_target = create_target(y_t, y_hat, c_t)
-                theta_t_grad = y_target.dot(Phi_x_t) - y_hat.dot(Phi_x_t) 
+                theta_t_grad = project(y_target) - project(y_hat) 
             elif self.grad_model == "g1":
                 #Negative update scheme
-                pos_theta_t_grad = y_t.dot(Phi_x_t) - y_hat.dot(Phi_x_t)
-                theta_t_grad = T.switch(T.eq(c_t[5], 1.0), -pos_theta_t_grad, pos_theta_t_grad)
+                pos_theta_t_grad = project(y_t) - project(y_hat)
+                theta_t_grad = T.switch(T.eq(flag(c_t, 5), 1.0), -pos_theta_t_grad, pos_theta_t_grad)
                 #if c_t[5] == 1: #if c_t[5] is 1 then the student knows their answer is wrong... so we use the "reverse" gradient
                 #    theta_t_grad = -theta_t_grad
                 #else:
                 #    pass
             elif self.grad_model == "g2":
                 #Interpolated REDISTRIBUTION AND NEGATIVE update scheme
-                pos_theta_t_grad = y_t.dot(Phi_x_t) - y_hat.dot(Phi_x_t)
+                pos_theta_t_grad = project(y_t) - project(y_hat)
                 neg_theta_t_grad = -pos_theta_t_grad
                 y_target = create_target(y_t, y_hat, c_t)
-                redistribute_theta_t_grad = y_target.dot(Phi_x_t) - y_hat.dot(Phi_x_t) 
+                redistribute_theta_t_grad = project(y_target) - project(y_hat) 
                 merge_theta_t_grad = merge * neg_theta_t_grad + (1.0 - merge) * redistribute_theta_t_grad
-                theta_t_grad = T.switch(T.eq(c_t[5],1.0), merge_theta_t_grad, pos_theta_t_grad)
+                theta_t_grad = T.switch(T.eq(flag(c_t, 5),1.0), merge_theta_t_grad, pos_theta_t_grad)
                 #if c_t[5] == 1:
                 #    y_target = create_target(y_t, y_hat, c_t)
                 #    theta_t_grad_g2 = y_target.dot(Phi_x_t) - y_hat.dot(Phi_x_t) 
@@ -305,11 +592,15 @@ class RecurrentLoglinear(object):
                 pass
             elif self.grad_model == "g3":
                 #Feature Vector Update scheme
-                y_t_idx = T.argmax(y_t)
-                Phi_x_y = Phi_x_t[y_t_idx,:] #(D,)
-                Phi_x_y = T.reshape(Phi_x_y, (self.dh.FEAT_SIZE,)) #(Y,D)
-                theta_t_grad = T.switch(T.eq(c_t[5],1.0), Phi_x_y, -Phi_x_y)
-                norm = T.sum(theta_t_grad)
+                if batch:
+                    y_t_one_hot = T.eq(T.arange(self.dh.E_SIZE).dimshuffle('x', 0), T.argmax(y_t, axis=1).dimshuffle(0, 'x'))
+                    Phi_x_y = project(T.cast(y_t_one_hot, theano.config.floatX)) #(B,D)
+                else:
+                    y_t_idx = T.argmax(y_t)
+                    Phi_x_y = project(T.eq(T.arange(self.dh.E_SIZE), y_t_idx)) #(D,)
+                    Phi_x_y = T.reshape(Phi_x_y, (update_size,)) #(D,)
+                theta_t_grad = T.switch(T.eq(flag(c_t, 5),1.0), Phi_x_y, -Phi_x_y)
+                norm = T.sum(theta_t_grad, axis=1, keepdims=True) if batch else T.sum(theta_t_grad)
                 theta_t_grad = theta_t_grad / norm
             else:
                 raise BaseException("unknown user grad type")
@@ -317,27 +608,52 @@ class RecurrentLoglinear(object):
             if self.grad_transform == "0":
                 theta_t_grad = theta_t_grad #- (self.grad_transform * 2.0 * theta_t) #obs - exp
             elif self.grad_transform == "norm":
-                norm2 = T.sqrt(T.sum(T.sqr(self._eps + theta_t_grad)))
+                if batch:
+                    norm2 = T.sqrt(T.sum(T.sqr(self._eps + theta_t_grad), axis=1, keepdims=True))
+                else:
+                    norm2 = T.sqrt(T.sum(T.sqr(self._eps + theta_t_grad)))
                 theta_t_grad = theta_t_grad / norm2
             elif self.grad_transform == "sign":
                 theta_t_grad = T.switch(T.lt(theta_t_grad, 0), floatX(-0.01), theta_t_grad)
                 theta_t_grad = T.switch(T.gt(theta_t_grad, 0), floatX(0.01), theta_t_grad)
             else:
                 raise BaseException("unknown user ul")
-            theta_t_grad = T.reshape(theta_t_grad, (self.dh.FEAT_SIZE,)) #(D,)
-            if self.grad_top_k == "top_all":
+            if not batch:
+                theta_t_grad = T.reshape(theta_t_grad, (update_size,)) #(D,)
+            else:
                 pass
+            if self.grad_top_k == "top_all":
+                if compact:
+                    return self.phi_active_idx[x_t], theta_t_grad
+                else:
+                    pass
             elif self.grad_top_k.startswith("top_"):
-                k = int(self.grad_top_k.split("_")[1])
-                theta_t_grad_abs = T.abs_(theta_t_grad)
-                theta_t_grad_abs_argsort = T.argsort(theta_t_grad_abs)
-                theta_t_grad = T.set_subtensor(theta_t_grad[theta_t_grad_abs_argsort[:self.dh.FEAT_SIZE - k]],0)
+                k = min(int(self.grad_top_k.split("_")[1]), update_size)
+                #keeps every entry above the k-th largest |update| (a partial selection, topk) and fills the rest of the k
+                #slots with the lowest index entries tied with it. the old full argsort broke those ties in an arbitrary
+                #order, ties are common (features with equal weights) so top_k runs do not repeat the old ones exactly
+                abs_grad = T.abs_(theta_t_grad)
+                kth = T.min(T.topk(abs_grad, k, sorted = False), axis = -1, keepdims = True)
+                above = T.gt(abs_grad, kth * (1.0 + TOP_K_TIE_TOL))
+                tied = T.and_(T.ge(abs_grad, kth * (1.0 - TOP_K_TIE_TOL)), T.invert(above))
+                tie_rank = T.cumsum(T.cast(tied, 'int32'), axis = -1) #cumsum keeps the dtype, a bool one would stop at 1
+                keep = T.or_(above, T.and_(tied, T.le(tie_rank, k - T.sum(above, axis = -1, keepdims = True))))
+                if compact or sparse:
+                    top_idx = T.argtopk(T.cast(keep, 'int8'), k, sorted = False) #exactly k entries are kept
+                else:
+                    pass
+                if compact:
+                    return self.phi_active_idx[x_t][top_idx], theta_t_grad[top_idx]
+                elif sparse:
+                    return top_idx, theta_t_grad[top_idx]
+                else:
+                    theta_t_grad = T.switch(keep, theta_t_grad, 0)
             else:
                 raise BaseException("unknown grad top k")
             return theta_t_grad
 
-        def log_linear_t(x_t, y_t, yt_t, o_t, c_t, theta_tm1, merge = 1.0):
-            y_hat, Phi_x_t = obs_model(x_t, o_t, theta_tm1)
+        def log_linear_t(x_t, y_t, yt_t, o_t, c_t, theta_tm1, merge = 1.0, opts = None):
+            y_hat = obs_model(x_t, o_t, theta_tm1, opts = opts)
             #model_loss, model_bin_loss = compute_losses(y_hat, y_t, yt_t)
             #model_loss = compute_losses(y_hat, y_t, yt_t)
             model_loss = compute_losses(y_hat, y_t)
@@ -345,20 +661,25 @@ class RecurrentLoglinear(object):
             y_hat = T.reshape(y_hat, (self.dh.E_SIZE,)) #(Y,)
             return theta_t_grad, y_hat, model_loss #, model_bin_loss
 
-        def transition_model(x_t, y_t, o_t, s_t, s_tm1, theta_tm1, merge = 1.0):
+        def transition_model(x_t, y_t, o_t, s_t, s_tm1, theta_tm1, merge = 1.0, opts = None, gates = None):
+            #gates=(g_r, g_z) of this step when they were computed ahead (context_gates)
             c_t = s_t[:10] #T.set_subtensor(s_t[[6,7,8]],0)
             c_tm1 = s_tm1[:10] #T.set_subtensor(s_tm1[[6, 7,8]],0)
             c_t = T.reshape(c_t, (self.context_size,))
             c_tm1 = T.reshape(c_tm1, (self.context_size,))
             #update_t, y_hat, loss_t, bin_loss_t = log_linear_t(x_t, y_t, yt_t, o_t, c_t, merge, temp, theta_tm1) #(D,) and scalar
-            y_hat, Phi_x_t = obs_model(x_t, o_t, theta_tm1)
-            update_t = compute_update(x_t, y_hat, y_t, c_t, merge)
-            if self.learning_model == "m0":
+            y_hat = obs_model(x_t, o_t, theta_tm1, opts = opts)
+            if self.grad_top_k == "top_all":
+                update_t = compute_update(x_t, y_hat, y_t, c_t, merge)
+            else:
+                update_idx, update_val = compute_update(x_t, y_hat, y_t, c_t, merge, sparse = True) #(k,) and (k,)
+            if gates is not None:
+                g_r, g_z = gates
+            elif self.learning_model == "m0":
                 W_r = self.params[0]
                 W_z = self.params[1]
                 g_r = T.nnet.sigmoid(W_r)  
                 g_z = T.nnet.sigmoid(W_z)  
-                theta_t = g_r * theta_tm1 + g_z * update_t
             elif self.learning_model == "m1":
                 W_r = self.params[0]
                 W_z = self.params[1]
@@ -366,7 +687,6 @@ class RecurrentLoglinear(object):
                 b_r = self.params[3]
                 g_r = T.nnet.sigmoid(W_r + b_r)
                 g_z = T.nnet.sigmoid(W_z + b_z) 
-                theta_t = g_r * theta_tm1 + g_z * update_t
             elif self.learning_model == "m3":
                 W_zc = self.params[0]
                 W_rc = self.params[1]
@@ -376,7 +696,6 @@ class RecurrentLoglinear(object):
                 b_r = self.params[5]
                 g_r = T.nnet.sigmoid(W_rc.dot(W_rc2.dot(c_tm1)) + b_r)
                 g_z = T.nnet.sigmoid(W_zc.dot(W_zc2.dot(c_t)) + b_z) #<--- everything but input x
-                theta_t = g_r * theta_tm1 + g_z * update_t
             elif self.learning_model == 'm4':
                 W_zc = self.params[0]
                 W_rc = self.params[1]
@@ -384,9 +703,14 @@ class RecurrentLoglinear(object):
                 b_r = self.params[3]
                 g_r = T.nnet.sigmoid(W_rc.dot(c_tm1) + b_r)
                 g_z = T.nnet.sigmoid(W_zc.dot(c_t) + b_z) #<--- everything but input x
-                theta_t = g_r * theta_tm1 + g_z * update_t
             else:
                 raise BaseException("unknown learning model")
+            if self.grad_top_k == "top_all":
+                theta_t = g_r * theta_tm1 + g_z * update_t
+            else:
+                #only the k selected features get an update term
+                g_z_k = g_z[update_idx] if g_z.ndim == 1 else g_z
+                theta_t = T.inc_subtensor((g_r * theta_tm1)[update_idx], g_z_k * update_val)
             theta_t = T.switch(T.eq(c_t[6], 1.0), theta_tm1, theta_t) #if c_t has no feedback then do not change theta...
             if self.clip:
                 theta_t = T.clip(theta_t, -1.0, 1.0)
@@ -394,46 +718,97 @@ class RecurrentLoglinear(object):
                 pass
             return theta_t, g_r, g_z
         
-        def recurrence(x_t, y_t, yt_t, o_t, s_t, s_tm1, theta_tm1):
+        def merge_model(c_t):
+            if self.grad_model == "g2":
+                b_m = self.params[-1]
+                W_m1 = self.params[-2]
+                W_m2 = self.params[-3]
+                if c_t.ndim == 2:
+                    merge = T.nnet.sigmoid(c_t.dot(W_m2.T).dot(W_m1.T) + b_m) #(B,D)
+                else:
+                    merge = T.nnet.sigmoid(W_m1.dot(W_m2.dot(c_t)) + b_m)
+            elif self.grad_model == "g0" or self.grad_model == "g1" or self.grad_model == "g3":
+                merge = self.b_m #always 1
+            else:
+                raise BaseException("unknown grad model")
+            return merge
+
+        def fixed_gates():
+            #m0 and m1 gates do not depend on the context
+            if self.learning_model == "m0":
+                return T.nnet.sigmoid(self.params[0]), T.nnet.sigmoid(self.params[1])
+            else:
+                W_r, W_z, b_z, b_r = self.params[:4]
+                return T.nnet.sigmoid(W_r + b_r), T.nnet.sigmoid(W_z + b_z)
+
+        def context_gates(C, CM1):
+            #m3 and m4 gates only depend on the context, for a whole sequence of contexts C (N,10) and CM1 (N,10)
+            #they are one matrix product each instead of a (D,10) dot (10,) per step inside the scan, (N,D)
+            if self.learning_model == "m3":
+                W_zc, W_rc, W_zc2, W_rc2, b_z, b_r = self.params[:6]
+                return T.nnet.sigmoid(CM1.dot(W_rc2.T).dot(W_rc.T) + b_r), T.nnet.sigmoid(C.dot(W_zc2.T).dot(W_zc.T) + b_z)
+            else:
+                W_zc, W_rc, b_z, b_r = self.params[:4]
+                return T.nnet.sigmoid(CM1.dot(W_rc.T) + b_r), T.nnet.sigmoid(C.dot(W_zc.T) + b_z)
+
+        def recurrence(x_t, y_t, yt_t, o_t, oi_t, on_t, s_t, s_tm1, theta_tm1, gates = None):
             #x_t (scalar)
             #y_t (Y,)
             #o_t (Y,)
             #s_t (self.context_size,)
             #theta_tm1 (D,)
-            s_t = T.reshape(s_t, (self.context_size + (3  * self.dh.E_SIZE),))
-            s_tm1 = T.reshape(s_tm1, (self.context_size + (3  * self.dh.E_SIZE),))
+            s_t = T.reshape(s_t, (self.context_size,))
+            s_tm1 = T.reshape(s_tm1, (self.context_size,))
             c_t = s_t[:10] #T.set_subtensor(s_t[[6,7,8]],0)
             c_tm1 = s_tm1[:10] #T.set_subtensor(s_tm1[[6, 7,8]],0)
             c_t = T.reshape(c_t, (self.context_size,))
             c_tm1 = T.reshape(c_tm1, (self.context_size,))
             theta_tm1 = T.reshape(theta_tm1, (self.dh.FEAT_SIZE,))
             #update_t, y_hat, loss_t, bin_loss_t = log_linear_t(x_t, y_t, yt_t, o_t, c_t, theta_tm1) #(D,) and scalar
-            if self.grad_model == "g2":
-                b_m = self.params[-1]
-                W_m1 = self.params[-2]
-                W_m2 = self.params[-3]
-                merge = T.nnet.sigmoid(W_m1.dot(W_m2.dot(c_t)) + b_m)
-            elif self.grad_model == "g0" or self.grad_model == "g1" or self.grad_model == "g3":
-                merge = self.b_m #always 1
-            else:
-                raise BaseException("unknown grad model")
-
-            update_t, y_hat, loss_t = log_linear_t(x_t, y_t, yt_t, o_t, c_t, theta_tm1, merge) #(D,) and scalar
-            theta_t, g_r, g_z = transition_model(x_t, y_t, o_t, s_t, s_tm1, theta_tm1, merge)
+            merge = merge_model(c_t)
+            update_t, y_hat, loss_t = log_linear_t(x_t, y_t, yt_t, o_t, c_t, theta_tm1, merge, (oi_t, on_t)) #(D,) and scalar
+            theta_t, g_r, g_z = transition_model(x_t, y_t, o_t, s_t, s_tm1, theta_tm1, merge, (oi_t, on_t), gates)
             #r_loss_t, c_loss_t, ic_loss_t, bin_loss_t = assign_losses(loss_t, bin_loss_t, c_t)
             r_loss_t, c_loss_t, ic_loss_t = assign_losses(loss_t, c_t)
             #return theta_t, y_hat, loss_t, r_loss_t, c_loss_t, ic_loss_t, bin_loss_t, update_t, g_r, g_z
             return theta_t, y_hat, loss_t, r_loss_t, c_loss_t, ic_loss_t, update_t, g_r, g_z
 
-        [seq_thetas, seq_y_hats, all_losses, r_losses, c_losses, ic_losses, seq_updates, seq_g_r, seq_g_z], _ = theano.scan(fn=recurrence, 
-                sequences=[X,Y,YT,O,S,SM1], 
-                outputs_info=[theta_0, None, None, None, None, None, None, None, None])
+        def run_scan(SM1, R = None):
+            #the whole sequence recurrence. R (sequence_size,) is only given for packed sequences, several users back to back,
+            #it is 1.0 at the first event of each user and the state goes back to theta_0 there
+            OI, ON = option_index(O) #once per sequence, outside the scan. unused (and dropped by scan) with softmax="full"
+            resets = [] if R is None else [R]
+            starts = [] if R is None else [theta_0]
+            gated = self.learning_model in ["m3", "m4"]
+            G = list(context_gates(S[:, :10], SM1[:, :10])) if gated else [] #(T,D) each
+            def step(*args):
+                #x_t, y_t, yt_t, o_t, oi_t, on_t, s_t, s_tm1, [g_r_t, g_z_t], [r_t], theta_tm1, [theta_0]
+                gates = tuple(args[8:10]) if gated else None
+                rest = args[8 + len(G):]
+                if R is None:
+                    theta_tm1, = rest
+                else:
+                    r_t, theta_tm1, theta_start = rest
+                    theta_tm1 = ifelse(T.gt(r_t, 0), theta_start, theta_tm1)
+                return recurrence(*(list(args[:8]) + [theta_tm1, gates]))
+            [seq_thetas, seq_y_hats, all_losses, r_losses, c_losses, ic_losses, seq_updates, seq_g_r, seq_g_z], _ = theano.scan(fn=step,
+                    sequences=[X,Y,YT,O,OI,ON,S,SM1] + G + resets,
+                    outputs_info=[theta_0, None, None, None, None, None, None, None, None],
+                    non_sequences=starts)
+            return seq_thetas, seq_y_hats, all_losses, r_losses, c_losses, ic_losses, seq_updates, seq_g_r, seq_g_z
+
+        seq_thetas, seq_y_hats, all_losses, r_losses, c_losses, ic_losses, seq_updates, seq_g_r, seq_g_z = run_scan(SM1)
 
         all_loss = T.sum(all_losses)
         #def log_linear_t(x_t, y_t, yt_t, o_t, c_t, merge, temp, theta_tm1):
 
-        _y_hat, _phi_x_t = obs_model(_x_t, _o_t, _theta_tm1)
-        _theta_t, _g_r, _g_z = transition_model(_x_t, _y_t, _o_t, _s_t, _s_tm1, _theta_tm1)
+        _oi, _on = option_index(_o_t.dimshuffle('x', 0))
+        _y_hat = obs_model(_x_t, _o_t, _theta_tm1, opts = (_oi[0], _on[0]))
+        #y_hat of every row of an action table (e.g. dh.quiz_action_xs, dh.quiz_action_options) under one theta
+        _ois, _ons = option_index(_os)
+        _y_hats, _ = theano.scan(fn=lambda x_t, o_t, oi_t, on_t, theta: T.reshape(obs_model(x_t, o_t, theta, opts = (oi_t, on_t)), (self.dh.E_SIZE,)),
+                sequences=[_xs, _os, _ois, _ons], non_sequences=_theta_tm1) #(A,Y)
+        _theta_t, _g_r, _g_z = transition_model(_x_t, _y_t, _o_t, _s_t, _s_tm1, _theta_tm1, opts = (_oi[0], _on[0]))
         _theta_t = _theta_t * (T.abs_(_theta_t) > self._eps)
         _g_r = _g_r * (T.abs_(_g_r) > self._eps)
         _g_z = _g_z * (T.abs_(_g_z) > self._eps)
@@ -455,16 +830,96 @@ class RecurrentLoglinear(object):
             reg_loss += T.sum(T.sqr(reg_param))
         model_loss = (self.use_sum_loss * sum_loss) + ((1.0 - self.use_sum_loss) * mean_loss)  
         total_loss = model_loss + (self.l * reg_loss)
-        self.get_step_y_hat = theano.function(inputs=[_x_t, _o_t, _theta_tm1], outputs=_y_hat)
-        self.get_step_transition = theano.function(inputs=[_x_t, _y_t, _o_t, _s_t, _s_tm1, _theta_tm1], outputs=[_theta_t, _g_r, _g_z]) 
-        self.get_params = theano.function(inputs = [], outputs = [T.as_tensor_variable(p) for p in self.params])
-        self.get_seq_losses = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [all_losses, c_losses, ic_losses, all_losses])
-        self.get_loss = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [total_loss, model_loss, all_loss, c_loss, ic_loss, model_loss])
-        self.get_seq_y_hats = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_y_hats)
-        self.get_seq_thetas = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_thetas)
-        self.get_seq_updates = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_updates)
-        self.get_seq_g_r = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_g_r)
-        self.get_seq_g_z = theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_g_z)
-        self.do_update = theano.function([X, Y, YT, O, S, SM1, theta_0, lr], 
+        #per event category masks, columns in EVAL_MASKS order
+        eval_masks = T.stack([T.max(S[:, [4, 5, 6]], axis=1), T.max(S[:, [4, 7]], axis=1), T.max(S[:, [5, 8]], axis=1),
+            T.max(S[:, [0, 3]], axis=1), S[:, 2], S[:, 1] * (1.0 - S[:, 3])], axis=1) > 0 #(sequence_size, 6)
+        #truncated backprop: one window of a user's events starting from the theta the previous window ended with,
+        #gradients stop at the window start so the scan keeps (window, D) for the backward pass whatever the history length.
+        #reg_w is the window's share of the user's events, so a user's windows add up to one reg term as in do_train
+        reg_w = T.scalar('reg_w', dtype=theano.config.floatX)
+        w_total_loss = model_loss + (reg_w * self.l * reg_loss)
+        #packed sequences: many users back to back in one call, SM1 is S shifted by one with zeros at each user's first event
+        PSM1 = T.concatenate([T.zeros_like(S[:1]), S[:-1]], axis=0) * (1.0 - R).dimshuffle(0, 'x')
+        p_thetas, p_y_hats, p_all_losses, _, p_c_losses, p_ic_losses, _, _, _ = run_scan(PSM1, R)
+        p_model_loss = T.sum(p_c_losses) + T.sum(p_ic_losses)
+        #same objective as summing do_update's total_loss over the users in the packed sequence (as the batched graph)
+        p_total_loss = p_model_loss + (T.sum(R) * self.l * reg_loss)
+        #compiled on first use, see compile_function
+        self._fn_specs.update({
+            'get_step_y_hat': lambda: theano.function(inputs=[_x_t, _o_t, _theta_tm1], outputs=_y_hat),
+            'get_step_y_hats': lambda: theano.function(inputs=[_xs, _os, _theta_tm1], outputs=_y_hats),
+            'get_step_transition': lambda: theano.function(inputs=[_x_t, _y_t, _o_t, _s_t, _s_tm1, _theta_tm1], outputs=[_theta_t, _g_r, _g_z]),
+            'get_params': lambda: theano.function(inputs = [], outputs = [T.as_tensor_variable(p) for p in self.params]),
+            'get_seq_losses': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [all_losses, c_losses, ic_losses, all_losses]),
+            'get_loss': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [total_loss, model_loss, all_loss, c_loss, ic_loss, model_loss]),
+            'apply_grads': lambda: self.apply_grads_function(),
+            'get_grads': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [total_loss] + T.grad(total_loss, self.params)),
+            'get_eval': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = [total_loss, model_loss, all_losses, c_losses, ic_losses, seq_y_hats, eval_masks]),
+            'get_seq_y_hats': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_y_hats),
+            'get_seq_thetas': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_thetas),
+            'get_seq_updates': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_updates),
+            'get_seq_g_r': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_g_r),
+            'get_seq_g_z': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0], outputs = seq_g_z),
+            'do_update': lambda: theano.function([X, Y, YT, O, S, SM1, theta_0, lr], 
                 outputs= [total_loss, seq_thetas, seq_y_hats], 
-                updates = self._update(total_loss, self.params, lr))
+                updates = self._update(total_loss, self.params, lr)),
+            'do_train': lambda: self.train_function([X, Y, YT, O, S, SM1, theta_0, lr], total_loss, [seq_y_hats], lr),
+            'do_window_train': lambda: self.train_function([X, Y, YT, O, S, SM1, theta_0, reg_w, lr], w_total_loss, [seq_y_hats], lr, [seq_thetas[-1]]),
+            'get_packed_eval': lambda: theano.function([X, Y, YT, O, S, R, theta_0], outputs = [p_all_losses, p_c_losses, p_ic_losses, p_y_hats, eval_masks]),
+            'do_packed_update': lambda: theano.function([X, Y, YT, O, S, R, theta_0, lr],
+                outputs = [p_total_loss, p_thetas, p_y_hats],
+                updates = self._update(p_total_loss, self.params, lr)),
+            'do_packed_train': lambda: self.train_function([X, Y, YT, O, S, R, theta_0, lr], p_total_loss, [p_y_hats], lr)})
+        if self.batch_size > 1:
+            #batched training on many users per call, with the step helpers above on a batch (B,) of x.
+            #inputs are (batch_size, sequence_size, ...) with every user padded to the longest one in the batch (see data_reader.pad_batch),
+            #M marks the real events. the scan runs over time with theta as (batch_size, D), so each step is one batched product for all users.
+            B_X = T.imatrix('X') #(batch_size, sequence_size)
+            B_O = T.ftensor3('O') #(batch_size, sequence_size, output_dim)
+            B_Y = T.ftensor3('Y') #(batch_size, sequence_size, output_dim)
+            B_YT = T.imatrix('YT') #(batch_size, sequence_size)
+            B_S = T.ftensor3('S') #(batch_size, sequence_size, self.context_size)
+            B_SM1 = T.ftensor3('SM1') #(batch_size, sequence_size, self.context_size)
+            M = T.fmatrix('M') #(batch_size, sequence_size) 1 for real events 0 for padding
+            B_OI, B_ON = option_index(T.reshape(B_O, (B_O.shape[0] * B_O.shape[1], self.dh.E_SIZE)))
+            B_OI = T.reshape(B_OI, (B_O.shape[0], B_O.shape[1], B_OI.shape[1])) #(batch_size, sequence_size, P)
+            B_ON = T.reshape(B_ON, (B_O.shape[0], B_O.shape[1])) #(batch_size, sequence_size)
+
+            def batch_recurrence(x_t, y_t, yt_t, o_t, oi_t, on_t, c_t, c_tm1, m_t, theta_tm1):
+                #x_t (B,) y_t (B,Y) o_t (B,Y) c_t (B,self.context_size) m_t (B,) theta_tm1 (B,D)
+                merge = merge_model(c_t)
+                y_hat = obs_model(x_t, o_t, theta_tm1, opts = (oi_t, on_t))
+                loss_t = compute_losses(y_hat, y_t) #(B,)
+                update_t = compute_update(x_t, y_hat, y_t, c_t, merge)
+                g_r, g_z = fixed_gates() if self.learning_model in ["m0", "m1"] else context_gates(c_t, c_tm1) #(B,D) for m3/m4
+                theta_t = g_r * theta_tm1 + g_z * update_t
+                theta_t = T.switch(T.eq(flag(c_t, 6), 1.0), theta_tm1, theta_t) #if c_t has no feedback then do not change theta...
+                if self.clip:
+                    theta_t = T.clip(theta_t, -1.0, 1.0)
+                else:
+                    pass
+                theta_t = T.switch(m_t.dimshuffle(0, 'x'), theta_t, theta_tm1) #padding leaves theta alone
+                c_loss_t = T.switch(T.any(c_t[:, [4, 7]], axis=1), loss_t, 0) * m_t
+                ic_loss_t = T.switch(T.any(c_t[:, [5, 8]], axis=1), loss_t, 0) * m_t
+                return theta_t, y_hat, c_loss_t, ic_loss_t
+
+            theta_0_batch = T.alloc(theta_0, B_X.shape[0], self.dh.FEAT_SIZE)
+            [b_thetas, b_y_hats, b_c_losses, b_ic_losses], _ = theano.scan(fn=batch_recurrence,
+                    sequences=[B_X.T, B_Y.dimshuffle(1, 0, 2), B_YT.T, B_O.dimshuffle(1, 0, 2), B_OI.dimshuffle(1, 0, 2), B_ON.T,
+                        B_S.dimshuffle(1, 0, 2), B_SM1.dimshuffle(1, 0, 2), M.T],
+                    outputs_info=[theta_0_batch, None, None, None])
+            n_users = T.sum(T.max(M, axis=1)) #rows that are not all padding
+            b_model_loss = T.sum(b_c_losses) + T.sum(b_ic_losses)
+            #same objective as summing do_update's total_loss over the users in the batch
+            b_total_loss = b_model_loss + (n_users * self.l * reg_loss)
+            batch_y_hats = b_y_hats.dimshuffle(1, 0, 2) #(B,T,Y)
+            b_inputs = [B_X, B_Y, B_YT, B_O, B_S, B_SM1, M, theta_0]
+            self._fn_specs.update({
+                'get_batch_loss': lambda: theano.function(b_inputs, outputs = [b_total_loss, b_model_loss]),
+                'do_batch_update': lambda: theano.function(b_inputs + [lr],
+                    outputs = [b_total_loss, batch_y_hats],
+                    updates = self._update(b_total_loss, self.params, lr)),
+                'do_batch_train': lambda: self.train_function(b_inputs + [lr], b_total_loss, [batch_y_hats], lr)})
+        else:
+            pass
+
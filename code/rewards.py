@@ -33,24 +33,17 @@ class Reward(object):
         return True
 
     def get_match_reward(self, rll, theta_t):
-        r = 0.0
-        for qa in self.dh.quiz_action_vectors:
-            a_type, x_t, yt_t, o_t = qa
-            y_hat = rll.get_step_y_hat(x_t, o_t, theta_t)
-            y_hat = np.reshape(y_hat, (self.dh.E_SIZE,))
-            y_max_idx = np.argmax(y_hat)
-            phi_max = self.dh._phi(x_t, y_max_idx)
-            phi_true = self.dh._phi(x_t, yt_t)
-            feature_overlap = phi_max * phi_true 
-            feature_overlap_ratio = np.sum(feature_overlap) / np.sum(phi_true)
-            r += feature_overlap_ratio
+        xs, yts = self.dh.quiz_action_xs, self.dh.quiz_action_yts
+        y_hats = rll.get_step_y_hats(xs, self.dh.quiz_action_options, theta_t) #(Q,Y)
+        y_max_idxs = np.argmax(y_hats, axis=1)
+        phi_max = self.dh._phis(xs, y_max_idxs)
+        phi_true = self.dh._phis(xs, yts)
+        feature_overlap = phi_max * phi_true
+        feature_overlap_ratio = np.sum(feature_overlap, axis=1) / np.sum(phi_true, axis=1)
+        r = np.sum(feature_overlap_ratio)
         return r 
 
     def get_ll_reward(self, rll, theta_t):
-        r = 0.0
-        for qa in self.dh.quiz_action_vectors:
-            a_type, x_t, yt_t, o_t = qa
-            y_hat = rll.get_step_y_hat(x_t, o_t, theta_t)
-            y_hat = np.reshape(y_hat, (self.dh.E_SIZE,))
-            r += y_hat[yt_t]
+        y_hats = rll.get_step_y_hats(self.dh.quiz_action_xs, self.dh.quiz_action_options, theta_t) #(Q,Y)
+        r = np.sum(y_hats[np.arange(y_hats.shape[0]), self.dh.quiz_action_yts])
         return r
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import os
+import fcntl
+import numpy as np
+
+__author__ = 'arenduchintala'
+
+#a run's traces are two append-only files, trace_file + '.trace' holds float32 rows of TRACE_COLUMNS values, one
+#row per event, and trace_file + '.trace.idx' holds int64 rows of (epoch, user, offset, length) where offset and
+#length count events of the data file. every disp_eval of an epoch appends its users' rows and their index rows
+TRACE_COLUMNS = ['p_y_t', 'p_y_u', 'u_correct', 'u_incorrect', 'mc', 'tp', 'chance', 'seq_loss']
+TRACE_DTYPE = np.float32
+INDEX_DTYPE = np.int64
+
+
+def trace_paths(trace_file):
+    return trace_file + '.trace', trace_file + '.trace.idx'
+
+
+def append_trace(trace_file, epoch_idx, plot, offsets):
+    #plot is (events, TRACE_COLUMNS) for all users of a split, user u is plot[offsets[u]:offsets[u + 1]]
+    data_path, idx_path = trace_paths(trace_file)
+    plot = np.ascontiguousarray(plot, dtype=TRACE_DTYPE)
+    if plot.ndim != 2 or plot.shape[1] != len(TRACE_COLUMNS):
+        raise BaseException("trace rows should have " + str(len(TRACE_COLUMNS)) + " columns")
+    else:
+        pass
+    offsets = np.asarray(offsets, dtype=INDEX_DTYPE)
+    with open(data_path, 'ab') as data_file:
+        #evaluations of several epochs (EvalPool workers) can append to the same run, the lock keeps an epoch's
+        #data and index rows together and its offsets right
+        fcntl.flock(data_file, fcntl.LOCK_EX)
+        try:
+            data_file.seek(0, os.SEEK_END)
+            start = data_file.tell() // (TRACE_DTYPE(0).itemsize * len(TRACE_COLUMNS))
+            data_file.write(plot.tostring())
+            data_file.flush()
+            index = np.zeros((offsets.shape[0] - 1, 4), dtype=INDEX_DTYPE)
+            index[:, 0] = epoch_idx
+            index[:, 1] = np.arange(offsets.shape[0] - 1)
+            index[:, 2] = start + offsets[:-1]
+            index[:, 3] = offsets[1:] - offsets[:-1]
+            with open(idx_path, 'ab') as idx_file:
+                idx_file.write(index.tostring())
+        finally:
+            fcntl.flock(data_file, fcntl.LOCK_UN)
+
+
+class TraceReader(object):
+    #memory mapped view of a run's traces, get(epoch, user) is a (TRACE_COLUMNS, events) slice of the map, rows in
+    #the order of the old text traces. if an epoch was written more than once the last one is read
+    def __init__(self, trace_file):
+        data_path, idx_path = trace_paths(trace_file)
+        index = np.fromfile(idx_path, dtype=INDEX_DTYPE).reshape((-1, 4))
+        n_rows = os.path.getsize(data_path) // (TRACE_DTYPE(0).itemsize * len(TRACE_COLUMNS))
+        if n_rows > 0:
+            self.data = np.memmap(data_path, dtype=TRACE_DTYPE, mode='r', shape=(n_rows, len(TRACE_COLUMNS)))
+        else:
+            self.data = np.zeros((0, len(TRACE_COLUMNS)), dtype=TRACE_DTYPE)
+        self.index = {}
+        for epoch_idx, user_idx, offset, length in index:
+            if offset + length > n_rows:
+                pass #index rows of an epoch still being written
+            else:
+                self.index[int(epoch_idx), int(user_idx)] = (int(offset), int(length))
+
+    def epochs(self):
+        return sorted(set([e for e, u in self.index]))
+
+    def users(self, epoch_idx):
+        return sorted([u for e, u in self.index if e == epoch_idx])
+
+    def get(self, epoch_idx, user_idx):
+        offset, length = self.index[epoch_idx, user_idx]
+        return self.data[offset:offset + length].T
+
+    def column(self, epoch_idx, user_idx, name):
+        return self.get(epoch_idx, user_idx)[TRACE_COLUMNS.index(name)]
+
+    def epoch(self, epoch_idx):
+        return [self.get(epoch_idx, u) for u in self.users(epoch_idx)]
@@ -4,9 +4,11 @@ import sys
 import codecs
 import numpy as np
 import theano
-from code.data_reader import read_data
+from code.data_reader import read_data, length_batches, pad_batch
 from code.datahelper import DataHelper
 from code.recurrent_loglinear import RecurrentLoglinear
+from code.np_loglinear import numpy_trainer
+from code.parallel import GradientPool, EvalPool
 from code.eval_tools import disp_eval, pad_start
 from code.my_utils import save_obj, load_obj
 
@@ -21,6 +23,12 @@ else:
     floatX = np.float64
     intX = np.int64
 
+
+def same_eval(a, b):
+    #(loss, p_u, acc) of two evaluations of the same params. they can run different graphs (packed or per user, an
+    #EvalPool worker) whose float32 sums differ in the last bits, so loss and p_u get a tolerance and acc one flipped tie
+    return np.allclose(a[:2], b[:2], rtol = 1e-4) and abs(a[2] - b[2]) <= 1
+
 if __name__ == '__main__':
     np.random.seed(1234)
     sys.setrecursionlimit(50000)
@@ -37,18 +45,57 @@ if __name__ == '__main__':
     opt.add_argument('-t', action='store', dest='temp', default="t1", required=True)
     opt.add_argument('--st', action='store', dest='save_trace', default=None)
     opt.add_argument('--sm', action='store', dest='save_model', default=None)
+    opt.add_argument('--phi', action='store', dest='phi_type', default='dense', choices=['dense', 'sparse', 'active', 'binary', 'lowrank'])
+    opt.add_argument('--rank', action='store', dest='low_rank', default=100, type=int)
+    opt.add_argument('--mmap', action='store_true', dest='mmap', default=False)
+    opt.add_argument('--softmax', action='store', dest='softmax', default='full', choices=['full', 'options'])
+    opt.add_argument('--batch', action='store', dest='batch_size', default=1, type=int) #users per padded training call, only faster than one call per user with --phi active
+    opt.add_argument('--pack', action='store', dest='pack', default=0, type=int) #users per packed train/eval call, 0 is one call per user
+    opt.add_argument('--bptt', action='store', dest='bptt', default=0, type=int) #truncated backprop window in events, 0 backprops through the whole user
+    opt.add_argument('--workers', action='store', dest='workers', default=0, type=int) #processes computing per user gradients, 0 trains in this process
+    opt.add_argument('--eval_workers', action='store', dest='eval_workers', default=0, type=int) #processes evaluating an epoch while the next one trains, 0 evaluates in this process
+    opt.add_argument('--minibatch', action='store', dest='minibatch', default=16, type=int) #users per update with --workers
+    opt.add_argument('--backend', action='store', dest='backend', default='theano', choices=['theano', 'numpy']) #numpy: hand derived m0/m1 training, see np_loglinear.NumpyRecurrentLoglinear
     opt.add_argument('--train', action='store', dest='training_data', default='./data/data_splits/train.data', required=False)
     opt.add_argument('--dev', action='store', dest='dev_data', default='./data/data_splits/dev.data', required=False)
     opt.add_argument('--test', action='store', dest='test_data', default='./data/data_splits/test.data', required=False)
     opt.add_argument('--check', action='store_true', dest='check_saved_models', default=False, required=False)
+    opt.add_argument('--debug', action='store_true', dest='debug', default=False, required=False) #train with do_update, checks thetas, y_hats and params on the host
     options = opt.parse_args()
     events_file = './data/content/fake-en-medium.' + options.feature  +'.event2feats'
     feats_file = './data/content/fake-en-medium.' + options.feature  +'.feat2id'
     actions_file = './data/content/fake-en-medium.mc.tp.mcr.tpr.actions'
-    dh = DataHelper(events_file, feats_file, actions_file)
-    TRAINING_SEQ = read_data(options.training_data, dh)
-    DEV_SEQ = read_data(options.dev_data, dh)
-    T_SEQ = read_data(options.test_data, dh)
+    dh = DataHelper(events_file, feats_file, actions_file, phi_type = options.phi_type, mmap = options.mmap, low_rank = options.low_rank)
+    if options.phi_type == "lowrank":
+        print 'phi:', dh.lowrank_report()
+    else:
+        pass
+    TRAINING_SEQ = read_data(options.training_data, dh, options.mmap)
+    DEV_SEQ = read_data(options.dev_data, dh, options.mmap)
+    T_SEQ = read_data(options.test_data, dh, options.mmap)
+
+    if options.batch_size > 1 and options.phi_type not in ["dense", "active"]:
+        raise Exception("--batch needs --phi dense or active")
+    else:
+        pass
+    if options.bptt > 0 and (options.batch_size > 1 or options.pack > 0):
+        raise Exception("--bptt trains one user per call, it can not be used with --batch or --pack")
+    else:
+        pass
+    if options.workers > 0 and (options.batch_size > 1 or options.pack > 0 or options.bptt > 0):
+        raise Exception("--workers computes whole user gradients, it can not be used with --batch, --pack or --bptt")
+    else:
+        pass
+    if options.backend == "numpy" and (options.batch_size > 1 or options.pack > 0 or options.bptt > 0):
+        raise Exception("--backend numpy trains one whole user per call, it can not be used with --batch, --pack or --bptt")
+    else:
+        pass
+    if options.backend == "numpy" and (options.model not in ["m0", "m1"] or options.grad_model not in ["g0", "g1"]):
+        raise Exception("--backend numpy only trains the m0 and m1 models with the g0 and g1 grad models")
+    elif options.backend == "numpy" and (options.grad_transform != "0" or options.top_k != "top_all" or options.phi_type == "lowrank"):
+        raise Exception("--backend numpy only trains with --gt 0, -k top_all and an exact phi (not --phi lowrank)")
+    else:
+        pass
 
     _theta_0 = np.zeros((dh.FEAT_SIZE,)).astype(floatX)
     _decay = 0.001
@@ -63,7 +110,17 @@ if __name__ == '__main__':
                         clip = _clip,
                         temp_model = options.temp,
                         grad_top_k = options.top_k,
-                        interpolate_bin_loss = options.interpolate_bin_loss)
+                        interpolate_bin_loss = options.interpolate_bin_loss,
+                        batch_size = options.batch_size,
+                        softmax = options.softmax)
+    #the numpy backend trains its own copy of the params, they are copied into sll for evaluation and saving
+    trainer = numpy_trainer(sll) if options.backend == "numpy" else None
+    #data parallel training: the workers sum the gradients of a minibatch of users, the update is applied here
+    grad_pool = GradientPool(trainer if trainer is not None else sll, TRAINING_SEQ, options.workers) if options.workers > 0 else None
+    #asynchronous evaluation: each epoch's params are evaluated by the pool while the next epoch trains
+    eval_splits = {'dev': DEV_SEQ, 'train': TRAINING_SEQ[:20], 'test': T_SEQ}
+    eval_pool = EvalPool(sll, dh, eval_splits, options.eval_workers, options.pack) if options.eval_workers > 0 else None
+    eval_pending = [] #(epoch_idx, params, handle) of submitted evaluations
     prev_dl = 1000000.0000
     prev_dacc = 0.0
     best_dl = 1000000.000
@@ -74,29 +131,121 @@ if __name__ == '__main__':
         lr = lr if options.grad_update == "sgd" else (0.05 / len(TRAINING_SEQ))
         shuffle_ids = np.random.choice(xrange(len(TRAINING_SEQ)), len(TRAINING_SEQ), False)
         sys.stderr.write('-')
-        for r_idx in shuffle_ids[:]:
-            sys.stderr.write('.')
-            _X, _Y, _YT, _O, _S = TRAINING_SEQ[r_idx]
-            _SM1 = pad_start(_S)
-            seq_losses, seq_thetas, seq_y_hats = sll.do_update(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
-            _params = sll.get_params()
-            #print '_params in main', _params
-            _max_p = []
-            if np.isnan(seq_losses):
-                raise Exception("loss is nan")
-            if np.isnan(seq_y_hats).any():
-                raise Exception("y_hat has nan")
-            for _p in _params:
-                if np.isnan(_p).any():
-                    raise Exception("_params is nan")
-                _max_p.append(np.max(_p))
-        msg_d,dl,dpu,dacc = disp_eval(DEV_SEQ, sll, dh, options.save_trace, epoch_idx) 
+        if options.batch_size > 1:
+            #users of similar length are trained together, one call per batch
+            for b_ids in length_batches(TRAINING_SEQ, options.batch_size):
+                sys.stderr.write('.')
+                _X, _Y, _YT, _O, _S, _SM1, _M = pad_batch(TRAINING_SEQ, b_ids)
+                if options.debug:
+                    seq_losses, seq_y_hats = sll.do_batch_update(_X, _Y, _YT, _O, _S, _SM1, _M, _theta_0, lr)
+                    if np.isnan(seq_losses):
+                        raise Exception("loss is nan")
+                    if np.isnan(seq_y_hats).any():
+                        raise Exception("y_hat has nan")
+                    for _p in sll.get_params():
+                        if np.isnan(_p).any():
+                            raise Exception("_params is nan")
+                else:
+                    seq_losses, non_finite = sll.do_batch_train(_X, _Y, _YT, _O, _S, _SM1, _M, _theta_0, lr)
+                    if non_finite:
+                        raise Exception("loss, y_hat or _params is not finite")
+        elif grad_pool is not None:
+            for m_start in xrange(0, len(shuffle_ids), options.minibatch):
+                sys.stderr.write('.')
+                _params = trainer.get_params() if trainer is not None else sll.get_params()
+                seq_losses, _grads = grad_pool.grads(_params, shuffle_ids[m_start:m_start + options.minibatch])
+                if not (np.isfinite(seq_losses) and all([np.all(np.isfinite(_g)) for _g in _grads])):
+                    raise Exception("loss or grads is not finite")
+                if trainer is not None:
+                    trainer.rmsprop(_grads, lr)
+                else:
+                    sll.apply_grads(*(_grads + [lr]))
+        elif options.pack > 0:
+            #pack users back to back, theta goes back to theta_0 at each user's first event, one update per pack
+            for p_start in xrange(0, len(shuffle_ids), options.pack):
+                sys.stderr.write('.')
+                _P = TRAINING_SEQ.take(shuffle_ids[p_start:p_start + options.pack])
+                _X, _Y, _YT, _O, _S = _P.fields
+                _R = _P.resets()
+                if options.debug:
+                    seq_losses, seq_thetas, seq_y_hats = sll.do_packed_update(_X, _Y, _YT, _O, _S, _R, _theta_0, lr)
+                    if np.isnan(seq_losses):
+                        raise Exception("loss is nan")
+                    if np.isnan(seq_y_hats).any():
+                        raise Exception("y_hat has nan")
+                    for _p in sll.get_params():
+                        if np.isnan(_p).any():
+                            raise Exception("_params is nan")
+                else:
+                    seq_losses, non_finite = sll.do_packed_train(_X, _Y, _YT, _O, _S, _R, _theta_0, lr)
+                    if non_finite:
+                        raise Exception("loss, y_hat or _params is not finite")
+        else:
+            for r_idx in shuffle_ids[:]:
+                sys.stderr.write('.')
+                _X, _Y, _YT, _O, _S = TRAINING_SEQ[r_idx]
+                _SM1 = pad_start(_S)
+                if trainer is not None:
+                    seq_losses, non_finite = trainer.do_train(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
+                    if non_finite:
+                        raise Exception("loss or _params is not finite")
+                elif options.bptt > 0:
+                    #windows of the user's events, each one an update, theta carries over from one window to the next
+                    _theta = _theta_0
+                    for w_start in xrange(0, _X.shape[0], options.bptt):
+                        w = slice(w_start, w_start + options.bptt)
+                        _reg_w = floatX(_X[w].shape[0] / float(_X.shape[0]))
+                        seq_losses, non_finite, _theta = sll.do_window_train(_X[w], _Y[w], _YT[w], _O[w], _S[w], _SM1[w], _theta, _reg_w, lr)
+                        if non_finite:
+                            raise Exception("loss, y_hat, theta or _params is not finite")
+                elif options.debug:
+                    seq_losses, seq_thetas, seq_y_hats = sll.do_update(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
+                    _params = sll.get_params()
+                    #print '_params in main', _params
+                    _max_p = []
+                    if np.isnan(seq_losses):
+                        raise Exception("loss is nan")
+                    if np.isnan(seq_y_hats).any():
+                        raise Exception("y_hat has nan")
+                    for _p in _params:
+                        if np.isnan(_p).any():
+                            raise Exception("_params is nan")
+                        _max_p.append(np.max(_p))
+                else:
+                    seq_losses, non_finite = sll.do_train(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
+                    if non_finite:
+                        raise Exception("loss, y_hat or _params is not finite")
+        if trainer is not None:
+            sll.set_params(trainer.get_params())
+        else:
+            pass
+        if eval_pool is not None:
+            #this epoch is submitted and the previous epoch's results (waited for if not done yet) drive the saving and
+            #early stopping below, which therefore act one epoch late
+            eval_requests = [('dev', options.save_trace), ('train', None), ('test', options.save_trace + '.test')]
+            _snapshot = sll.get_params()
+            eval_pending.append((epoch_idx, _snapshot, eval_pool.submit(_snapshot, epoch_idx, eval_requests)))
+            if len(eval_pending) < 2:
+                continue
+            else:
+                pass
+            eval_idx, eval_params, eval_handle = eval_pending.pop(0)
+            (msg_d,dl,dpu,dacc), (msg_t, tl, tpu, train_acc), (msg_test,testl,testpu,tacc) = eval_pool.collect(eval_handle)
+        else:
+            eval_params = None
+            msg_d,dl,dpu,dacc = disp_eval(DEV_SEQ, sll, dh, options.save_trace, epoch_idx, pack = options.pack) 
+            msg_t, tl, tpu, train_acc = disp_eval(TRAINING_SEQ[:20], sll, dh, None, None, pack = options.pack)
+            msg_test,testl,testpu,tacc = disp_eval(T_SEQ, sll, dh, options.save_trace + '.test', epoch_idx, pack = options.pack) 
         print 'dev:', msg_d
-        msg_t, tl, tpu, train_acc = disp_eval(TRAINING_SEQ[:20], sll, dh, None, None)
         print 'train:', msg_t
-        msg_test,testl,testpu,tacc = disp_eval(T_SEQ, sll, dh, options.save_trace + '.test', epoch_idx) 
         print 'test:', msg_test
         if dacc > prev_dacc and options.save_model is not None:
+            #saved (and checked) with the params that were evaluated
+            train_params = sll.get_params()
+            if eval_params is not None:
+                sll.set_params(eval_params)
+            else:
+                pass
             save_obj(sll, options.save_model) 
             sll.save_weights(options.save_model + '.json_params')
             if options.check_saved_models:
@@ -110,28 +259,30 @@ if __name__ == '__main__':
                                 temp_model = options.temp,
                                 grad_top_k = options.top_k,
                                 interpolate_bin_loss = options.interpolate_bin_loss, 
+                                softmax = options.softmax,
                                 saved_weights = options.save_model + '.json_params')
 
-                loaded_msg_d, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(DEV_SEQ, loaded_ll, dh, None, None)
-                print 'loaded_dev:', loaded_msg_d
-                loaded_msg_t, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(TRAINING_SEQ[:20], loaded_ll, dh, None, None)
-                print 'loaded_train:', loaded_msg_t
-                loaded_msg_test, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(T_SEQ, loaded_ll, dh, None, None)
-                print 'loaded_test:', loaded_msg_test
+                loaded_d = disp_eval(DEV_SEQ, loaded_ll, dh, None, None, pack = options.pack)
+                print 'loaded_dev:', loaded_d[0]
+                loaded_t = disp_eval(TRAINING_SEQ[:20], loaded_ll, dh, None, None, pack = options.pack)
+                print 'loaded_train:', loaded_t[0]
+                loaded_test = disp_eval(T_SEQ, loaded_ll, dh, None, None, pack = options.pack)
+                print 'loaded_test:', loaded_test[0]
 
                 pickle_loaded_ll = load_obj(options.save_model)
-                loaded_msg_pd, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(DEV_SEQ, pickle_loaded_ll, dh, None, None)
-                print 'pickle_loaded_dev:', loaded_msg_pd
-                loaded_msg_pt, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(TRAINING_SEQ[:20], pickle_loaded_ll, dh, None, None)
-                print 'pickle_loaded_train:', loaded_msg_pt
-                loaded_msg_ptest, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(T_SEQ, pickle_loaded_ll, dh, None, None)
-                print 'pickle_loaded_test:', loaded_msg_ptest
+                pickle_loaded_d = disp_eval(DEV_SEQ, pickle_loaded_ll, dh, None, None, pack = options.pack)
+                print 'pickle_loaded_dev:', pickle_loaded_d[0]
+                pickle_loaded_t = disp_eval(TRAINING_SEQ[:20], pickle_loaded_ll, dh, None, None, pack = options.pack)
+                print 'pickle_loaded_train:', pickle_loaded_t[0]
+                pickle_loaded_test = disp_eval(T_SEQ, pickle_loaded_ll, dh, None, None, pack = options.pack)
+                print 'pickle_loaded_test:', pickle_loaded_test[0]
 
-                assert msg_d == loaded_msg_d == loaded_msg_pd
-                assert msg_t == loaded_msg_t
-                assert msg_test == loaded_msg_test
+                assert same_eval((dl, dpu, dacc), loaded_d[1:]) and same_eval((dl, dpu, dacc), pickle_loaded_d[1:])
+                assert same_eval((tl, tpu, train_acc), loaded_t[1:])
+                assert same_eval((testl, testpu, tacc), loaded_test[1:])
             else:
                 pass
+            sll.set_params(train_params)
         else:
             pass
 
@@ -141,3 +292,16 @@ if __name__ == '__main__':
         else:
             pass
         prev_dacc = dacc
+    else:
+        #ran out of epochs without stopping early, the last epoch's evaluation is still in the pool
+        for eval_idx, eval_params, eval_handle in eval_pending:
+            for name, (msg, _, _, _) in zip(['dev', 'train', 'test'], eval_pool.collect(eval_handle)):
+                print name + ':', msg
+    if grad_pool is not None:
+        grad_pool.close()
+    else:
+        pass
+    if eval_pool is not None:
+        eval_pool.close()
+    else:
+        pass
@@ -9,6 +9,7 @@ from code.datahelper import DataHelper
 from code.recurrent_loglinear import RecurrentLoglinear
 from code.eval_tools import disp_eval, pad_start
 from code.my_utils import save_obj, load_obj
+from code.parallel import EvalPool
 
 sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 
@@ -38,14 +39,24 @@ if __name__ == '__main__':
     opt.add_argument('-t', action='store', dest='temp', default="t0")
     opt.add_argument('--st', action='store', dest='save_trace', default=None)
     opt.add_argument('--sm', action='store', dest='save_model', default=None)
+    opt.add_argument('--phi', action='store', dest='phi_type', default='dense', choices=['dense', 'sparse', 'active', 'binary', 'lowrank'])
+    opt.add_argument('--rank', action='store', dest='low_rank', default=100, type=int)
+    opt.add_argument('--mmap', action='store_true', dest='mmap', default=False)
+    opt.add_argument('--softmax', action='store', dest='softmax', default='full', choices=['full', 'options'])
     opt.add_argument('--train', action='store', dest='training_data', default='./data/data_splits/train.strata.0.data', required=True)
+    opt.add_argument('--debug', action='store_true', dest='debug', default=False, required=False) #train with do_update, checks thetas, y_hats and params on the host
+    opt.add_argument('--eval_workers', action='store', dest='eval_workers', default=0, type=int) #processes evaluating an epoch while the next one trains, 0 evaluates in this process
     options = opt.parse_args()
     events_file = './data/content/fake-en-medium.' + options.feature  +'.event2feats'
     feats_file = './data/content/fake-en-medium.' + options.feature  +'.feat2id'
     actions_file = './data/content/fake-en-medium.mc.tp.mcr.tpr.actions'
-    dh = DataHelper(events_file, feats_file, actions_file)
+    dh = DataHelper(events_file, feats_file, actions_file, phi_type = options.phi_type, mmap = options.mmap, low_rank = options.low_rank)
+    if options.phi_type == "lowrank":
+        print 'phi:', dh.lowrank_report()
+    else:
+        pass
     print 'training strata', options.training_data
-    TRAINING_SEQ = read_data(options.training_data, dh)
+    TRAINING_SEQ = read_data(options.training_data, dh, options.mmap)
     s_num = options.training_data.split('.')[-2]
     s_name = options.training_data.split('.')[-4].split('/')[-1]
     s_rest = '/'.join(options.training_data.split('/')[:-1]) + '/'
@@ -58,7 +69,7 @@ if __name__ == '__main__':
         print s_rest, s_name, s_dev_num
         d_f = s_rest + s_name + '.strata.' + s_dev_num + '.data'
         print 'using dev', d_f
-        DEV_SEQ += read_data(d_f, dh)
+        DEV_SEQ += read_data(d_f, dh, options.mmap)
 
     _theta_0 = np.zeros((dh.FEAT_SIZE,)).astype(floatX)
     _decay = 0.001
@@ -73,7 +84,11 @@ if __name__ == '__main__':
                         clip = _clip,
                         temp_model = options.temp,
                         grad_top_k = options.top_k,
-                        interpolate_bin_loss = options.interpolate_bin_loss)
+                        interpolate_bin_loss = options.interpolate_bin_loss,
+                        softmax = options.softmax)
+    #asynchronous evaluation: each epoch's params are evaluated by the pool while the next epoch trains
+    eval_pool = EvalPool(sll, dh, {'dev': DEV_SEQ, 'train': TRAINING_SEQ}, options.eval_workers) if options.eval_workers > 0 else None
+    eval_pending = [] #(epoch_idx, params, handle) of submitted evaluations
     prev_dl = 1000000.0000
     prev_dacc = 0.0
     best_dl = 1000000.000
@@ -88,23 +103,47 @@ if __name__ == '__main__':
             sys.stderr.write('.')
             _X, _Y, _YT, _O, _S = TRAINING_SEQ[r_idx]
             _SM1 = pad_start(_S)
-            seq_losses, seq_thetas, seq_y_hats = sll.do_update(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
-            _params = sll.get_params()
-            #print '_params in main', _params
-            _max_p = []
-            if np.isnan(seq_losses):
-                raise Exception("loss is nan")
-            if np.isnan(seq_y_hats).any():
-                raise Exception("y_hat has nan")
-            for _p in _params:
-                if np.isnan(_p).any():
-                    raise Exception("_params is nan")
-                _max_p.append(np.max(_p))
-        msg_d,dl,dpu,dacc = disp_eval(DEV_SEQ, sll, dh, options.save_trace, epoch_idx) 
+            if options.debug:
+                seq_losses, seq_thetas, seq_y_hats = sll.do_update(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
+                _params = sll.get_params()
+                #print '_params in main', _params
+                _max_p = []
+                if np.isnan(seq_losses):
+                    raise Exception("loss is nan")
+                if np.isnan(seq_y_hats).any():
+                    raise Exception("y_hat has nan")
+                for _p in _params:
+                    if np.isnan(_p).any():
+                        raise Exception("_params is nan")
+                    _max_p.append(np.max(_p))
+            else:
+                seq_losses, non_finite = sll.do_train(_X, _Y, _YT, _O, _S, _SM1, _theta_0, lr)
+                if non_finite:
+                    raise Exception("loss, y_hat or _params is not finite")
+        if eval_pool is not None:
+            #this epoch is submitted and the previous epoch's results (waited for if not done yet) drive the saving and
+            #early stopping below, which therefore act one epoch late
+            _snapshot = sll.get_params()
+            eval_pending.append((epoch_idx, _snapshot, eval_pool.submit(_snapshot, epoch_idx, [('dev', options.save_trace), ('train', None)])))
+            if len(eval_pending) < 2:
+                continue
+            else:
+                pass
+            eval_idx, eval_params, eval_handle = eval_pending.pop(0)
+            (msg_d,dl,dpu,dacc), (msg_t, tl, tpu, train_acc) = eval_pool.collect(eval_handle)
+        else:
+            eval_params = None
+            msg_d,dl,dpu,dacc = disp_eval(DEV_SEQ, sll, dh, options.save_trace, epoch_idx) 
+            msg_t, tl, tpu, train_acc = disp_eval(TRAINING_SEQ, sll, dh, None, None)
         print 'dev:', msg_d
-        msg_t, tl, tpu, train_acc = disp_eval(TRAINING_SEQ, sll, dh, None, None)
         print 'train:', msg_t
         if dacc > prev_dacc and options.save_model is not None:
+            #saved with the params that were evaluated
+            train_params = sll.get_params()
+            if eval_params is not None:
+                sll.set_params(eval_params)
+            else:
+                pass
             save_obj(sll, options.save_model) 
             sll.save_weights(options.save_model + '.json_params')
             if 0 == 1:
@@ -118,6 +157,7 @@ if __name__ == '__main__':
                                 temp_model = options.temp,
                                 grad_top_k = options.top_k,
                                 interpolate_bin_loss = options.interpolate_bin_loss, 
+                                softmax = options.softmax,
                                 saved_weights = options.save_model + '.json_params')
 
                 loaded_msg_d, loaded_dl, loaded_dpu, loaded_dacc = disp_eval(DEV_SEQ, loaded_ll, dh, None, None)
@@ -135,6 +175,7 @@ if __name__ == '__main__':
                 assert msg_t == loaded_msg_t
             else:
                 pass
+            sll.set_params(train_params)
         else:
             pass
 
@@ -144,3 +185,12 @@ if __name__ == '__main__':
         else:
             pass
         prev_dacc = dacc
+    else:
+        #ran out of epochs without stopping early, the last epoch's evaluation is still in the pool
+        for eval_idx, eval_params, eval_handle in eval_pending:
+            for name, (msg, _, _, _) in zip(['dev', 'train'], eval_pool.collect(eval_handle)):
+                print name + ':', msg
+    if eval_pool is not None:
+        eval_pool.close()
+    else:
+        pass
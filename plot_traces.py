@@ -5,6 +5,7 @@ import codecs
 import argparse
 import matplotlib.pyplot as plt
 import seaborn as sns
+from code.traces import TraceReader
 sys.stdout = codecs.getwriter('utf-8')(sys.stdout)
 __author__ = 'arenduchintala'
 
@@ -104,26 +105,21 @@ if __name__ == '__main__':
     #colors = sns.color_palette(n_colors=8).as_hex() #palette="Set2"
     colors = sns.color_palette("Paired",n_colors=6).as_hex() #palette="Set2"
     #colors.pop(3)
-    d_m2 = ("logs/traces/simple.m.m3.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut.iter.34", colors[5], "cm")
-    d_m1 = ("logs/traces/simple.m.m1.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut.iter.70", colors[3], "vm")
-    d_m0 = ("logs/traces/simple.m.m0.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut.iter.5", colors[1], "sm")
-    #d_m2 = ("logs/results/traces.m3_t2.dev.traces.iter.0",colors[2], "m3")
-    #d_m1 = ("logs/results/traces.m1_t0.dev.traces.iter.0", colors[1], "m1")
-    #d_m0 = ("logs/results/traces.m0_t0.dev.traces.iter.0", colors[0], "m0")
+    d_m2 = ("logs/traces/simple.m.m3.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut", 34, colors[5], "cm")
+    d_m1 = ("logs/traces/simple.m.m1.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut", 70, colors[3], "vm")
+    d_m0 = ("logs/traces/simple.m.m0.u.rms.r.0.001.gt.0.c.free.bl.0.0.gm.g1.t.t0.top_all.ut", 5, colors[1], "sm")
+    #d_m2 = ("logs/results/traces.m3_t2.dev.traces", 0, colors[2], "m3")
+    #d_m1 = ("logs/results/traces.m1_t0.dev.traces", 0, colors[1], "m1")
+    #d_m0 = ("logs/results/traces.m0_t0.dev.traces", 0, colors[0], "m0")
     file_data2users = {}
     users2p_data = {}
-    for file_path,color,mod in [d_m0, d_m2]:
-        _file = open(file_path, 'r').read().strip().split('\n')
-        for idx in range(0, len(_file), 8):
-            _p_y_t = [float(i) for i in _file[idx + 0].split()] 
-            _p_y_u = [float(i) for i in _file[idx + 1].split()] 
-            _u_c = [int(float(i)) for i in _file[idx + 2].split()] 
-            _u_ic = [int(float(i)) for i in _file[idx + 3].split()] 
-            _is_mc = [int(float(i)) for i in _file[idx + 4].split()] 
-            _is_tp = [int(float(i)) for i in _file[idx + 5].split()] 
-            _chance = [float(i) for i in _file[idx + 6].split()] 
+    for file_path,epoch_idx,color,mod in [d_m0, d_m2]:
+        trace = TraceReader(file_path)
+        for idx in trace.users(epoch_idx):
+            _p_y_t, _p_y_u, _u_c, _u_ic, _is_mc, _is_tp, _chance = trace.get(epoch_idx, idx)[:7]
+            _u_c, _u_ic, _is_mc, _is_tp = _u_c.astype(int), _u_ic.astype(int), _is_mc.astype(int), _is_tp.astype(int)
             if 0.0 in _chance:
-                print file_path, idx + 6
+                print file_path, epoch_idx, idx
                 print _chance
                 raise BaseException("zero in _chance")
             p_datas = users2p_data.get(idx, [])